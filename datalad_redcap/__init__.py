@@ -36,6 +36,12 @@ command_suite = (
             'export-redcap-report',
             'export_redcap_report'
         ),
+        (
+            'datalad_redcap.export_batch',
+            'ExportBatch',
+            'export-redcap-batch',
+            'export_redcap_batch'
+        ),
         (
             'datalad_redcap.query',
             'Query',
@@ -0,0 +1,239 @@
+"""An asyncio client for the REDCap API
+
+Requires the aiohttp package. Example::
+
+  async with AsyncProject(url, token) as project:
+      batches = await asyncio.gather(
+          *(project.export_records(format_type="csv", records=batch)
+            for batch in batches)
+      )
+"""
+
+import asyncio
+import logging
+import ssl
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from redcap import Project
+
+import datalad
+from datalad.distribution.dataset import Dataset
+
+from .client import (
+    DEFAULT_RETRIES,
+    MyInstruments,
+    MyProjectInfo,
+    DEFAULT_RETRY_DELAY,
+    RETRIES_VAR,
+    RETRY_DELAY_VAR,
+    TIMEOUT_VAR,
+    TRANSIENT_STATUS_CODES,
+    RedcapHTTPError,
+    _backoff_delay,
+    _http_error,
+    _parse_content,
+)
+from .ratelimit import get_rate_limiter
+
+lgr = logging.getLogger("datalad.redcap.aio")
+
+# default number of simultaneous connections to the server
+DEFAULT_LIMIT = 100
+
+# methods of PyCap's Project which upload files, and are not supported
+UPLOAD_METHODS = ("import_file", "import_file_into_repository")
+
+
+class _Capture(Exception):
+    """Raised to capture an API call instead of performing it"""
+
+    def __init__(self, payload: Dict[str, Any], return_type: str):
+        super().__init__(payload.get("content"))
+        self.payload = payload
+        self.return_type = return_type
+
+
+class _ReplayProject(Project):
+    """A PyCap project which replays known responses, and captures calls
+
+    Used to reuse PyCap's payload construction and response handling:
+    an API method is called once to capture the request it makes, and
+    again (once the response is known) to let it process the response.
+    """
+
+    # methods added by datalad-redcap
+    export_instruments = MyInstruments.export_instruments
+    export_project_xml = MyProjectInfo.export_project_xml
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._responses: Optional[Dict[tuple, Any]] = None
+
+    def _call_api(self, payload: Dict[str, Any], return_type: str, file=None):
+        key = _payload_key(payload)
+        if self._responses is not None and key in self._responses:
+            return self._responses[key]
+        raise _Capture(payload, return_type)
+
+
+class AsyncProject:
+    """Access the REDCap API of a project with awaitable methods
+
+    All export (and other) methods of PyCap's ``Project`` class, as well
+    as ``export_instruments`` and ``export_project_xml``, are available
+    as coroutines, taking the same arguments. Payloads are built, and
+    responses processed, by PyCap; requests are made with aiohttp,
+    using up to ``limit`` connections at the same time. Unlike the
+    synchronous API classes, csv and xml exports are returned as a
+    single string. Methods uploading files (``import_file`` and
+    ``import_file_into_repository``) are not available.
+
+    Requests are rate limited, and transient failures retried, as
+    configured for the synchronous classes (see ClientMixin). The
+    ``dataset`` argument selects the dataset whose configuration is
+    used.
+
+    Use as an async context manager, or call ``close`` when done.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        verify_ssl: Union[bool, str] = True,
+        limit: int = DEFAULT_LIMIT,
+        dataset: Optional[Dataset] = None,
+    ):
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError(
+                "The asyncio client requires aiohttp to be installed"
+            ) from e
+        self._project = _ReplayProject(url, token, verify_ssl=verify_ssl)
+        self.url = url
+        self.verify_ssl = verify_ssl
+        # like requests, accept the path to a CA bundle
+        self._ssl = (
+            ssl.create_default_context(cafile=verify_ssl)
+            if isinstance(verify_ssl, str)
+            else verify_ssl
+        )
+        self.limit = limit
+        cfg = dataset.config if dataset is not None else datalad.cfg
+        timeout = cfg.get(TIMEOUT_VAR)
+        self.timeout = float(timeout) if timeout else None
+        self.max_retries = int(cfg.get(RETRIES_VAR, DEFAULT_RETRIES))
+        self.retry_delay = float(cfg.get(RETRY_DELAY_VAR, DEFAULT_RETRY_DELAY))
+        self.retries = 0
+        self.retry_wait = 0.0
+        self._rate_limiter = get_rate_limiter(url, token, dataset)
+        self._session = None
+
+    async def __aenter__(self) -> "AsyncProject":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Close the connections to the server"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def __getattr__(self, name: str):
+        if (
+            name.startswith("_")
+            or name in UPLOAD_METHODS
+            or not callable(getattr(_ReplayProject, name, None))
+        ):
+            raise AttributeError(name)
+        method = getattr(self._project, name)
+
+        async def call(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+    async def _run(self, method, *args, **kwargs):
+        """Run a PyCap method, performing the requests it makes"""
+        responses = {}
+        while True:
+            # no other coroutine runs while the method runs, so it is
+            # safe to share the project object
+            self._project._responses = responses
+            try:
+                return method(*args, **kwargs)
+            except _Capture as capture:
+                payload, return_type = capture.payload, capture.return_type
+            finally:
+                self._project._responses = None
+            responses[_payload_key(payload)] = await self._call_api(
+                payload, return_type
+            )
+
+    async def _call_api(self, payload: Dict[str, Any], return_type: str) -> Any:
+        """Make a request, retrying after transient failures"""
+        import aiohttp
+
+        attempt = 0
+        while True:
+            if self._rate_limiter is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._rate_limiter.acquire
+                )
+            try:
+                return await self._request(payload, return_type)
+            except (RedcapHTTPError, aiohttp.ClientConnectionError) as e:
+                if attempt >= self.max_retries or not _is_transient_error(e):
+                    raise
+                delay = _backoff_delay(attempt, self.retry_delay)
+                lgr.debug("API request failed (%s), retrying in %.1f s", e, delay)
+                self.retries += 1
+                self.retry_wait += delay
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _request(self, payload: Dict[str, Any], return_type: str) -> Any:
+        """Make a single request, and return its content like PyCap would"""
+        session = self._get_session()
+        data = {k: v if isinstance(v, str) else str(v) for k, v in payload.items()}
+        async with session.post(self.url, data=data, ssl=self._ssl) as response:
+            content = await response.read()
+            headers = dict(response.headers)
+            status = response.status
+        if status >= 400:
+            raise _http_error(content.decode(errors="replace"), status)
+        return _parse_content(content, headers, payload, return_type)
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(sock_read=self.timeout),
+            )
+        return self._session
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """Tell if an error is likely to go away when trying again"""
+    if isinstance(e, RedcapHTTPError):
+        return e.status_code in TRANSIENT_STATUS_CODES
+    # timeouts rather suggest overload
+    return not isinstance(e, asyncio.TimeoutError)
+
+
+def _payload_key(payload: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    """Return a hashable representation of a payload"""
+    return tuple(sorted((k, str(v)) for k, v in payload.items()))
@@ -0,0 +1,88 @@
+"""On-disk cache of REDCap project metadata"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import (
+    Any,
+    Callable,
+)
+from uuid import uuid4
+
+import datalad
+
+lgr = logging.getLogger("datalad.redcap.cache")
+
+# configuration item with the cache lifetime, in seconds
+TTL_VAR = "datalad.redcap.metadata-cache-ttl"
+DEFAULT_TTL = 3600
+
+
+def get_cache_dir() -> Path:
+    """Return the directory of the metadata cache
+
+    The directory is placed in DataLad's cache location.
+    """
+    return Path(datalad.cfg.obtain("datalad.locations.cache")) / "redcap"
+
+
+def get_ttl() -> float:
+    """Return the configured cache lifetime in seconds (0 disables caching)"""
+    return float(datalad.cfg.get(TTL_VAR, DEFAULT_TTL))
+
+
+def cached(
+    name: str,
+    url: str,
+    token: str,
+    fetch: Callable[[], Any],
+    refresh: bool = False,
+) -> Any:
+    """Return cached metadata, or fetch and cache it
+
+    Metadata are cached per project, i.e. per API URL and token, and
+    ``name`` tells different kinds of metadata apart. ``fetch`` is
+    called to obtain the metadata if there is no cache entry, if the
+    entry is older than the configured lifetime, or if ``refresh`` is
+    True. Metadata need to be JSON-serializable. The token itself is
+    not stored, only a hash of it.
+    """
+    ttl = get_ttl()
+    cache_file = _cache_file(name, url, token)
+    if not refresh and ttl > 0:
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and time.time() - entry["timestamp"] < ttl:
+            lgr.debug("Using cached %s of %s", name, url)
+            return entry["data"]
+
+    data = fetch()
+    if ttl > 0:
+        _write_entry(cache_file, {"url": url, "timestamp": time.time(), "data": data})
+    return data
+
+
+def _cache_file(name: str, url: str, token: str) -> Path:
+    """Return the path of a cache entry"""
+    project = hashlib.sha256(f"{url}\0{token}".encode()).hexdigest()
+    return get_cache_dir() / project / f"{name}.json"
+
+
+def _write_entry(cache_file: Path, entry: dict):
+    """Write a cache entry, replacing the previous one in a single step"""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = cache_file.with_name(f".{cache_file.name}.{uuid4().hex[:8]}.part")
+    try:
+        with open(tmpfile, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmpfile, cache_file)
+    except OSError as e:
+        # a cache which can not be written is not worth failing for
+        lgr.debug("Could not write cache entry %s: %s", cache_file, e)
+        tmpfile.unlink(missing_ok=True)
@@ -0,0 +1,540 @@
+"""Extensions of PyCap's API classes"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import (
+    chain,
+    islice,
+)
+import json
+import logging
+import random
+from threading import Lock
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+import datalad
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from redcap.methods.instruments import Instruments
+from redcap.methods.metadata import Metadata
+from redcap.methods.project_info import ProjectInfo
+from redcap.methods.records import Records
+from redcap.methods.reports import Reports
+from redcap.request import RedcapError
+
+from datalad.distribution.dataset import Dataset
+
+from .ratelimit import get_rate_limiter
+
+lgr = logging.getLogger("datalad.redcap.client")
+
+# maximum number of connections kept alive per host (and session)
+POOL_MAXSIZE = 16
+
+# configuration item with the time (in seconds) to wait for the server
+# to send data, before a request fails with a timeout
+TIMEOUT_VAR = "datalad.redcap.request-timeout"
+
+# configuration items with the number of retries after transient
+# failures, and the base delay (in seconds) before the first retry
+RETRIES_VAR = "datalad.redcap.retries"
+RETRY_DELAY_VAR = "datalad.redcap.retry-delay"
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+# longest delay between two attempts, in seconds
+MAX_RETRY_DELAY = 60.0
+
+# HTTP status codes of responses worth retrying
+TRANSIENT_STATUS_CODES = (429, 502, 503, 504)
+
+# keep-alive sessions, shared by all API objects using the same API URL
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    """Return a session for the given API URL, shared within the process
+
+    Reusing the session (and its connection pool) across API calls
+    saves establishing a new connection, including the TLS handshake,
+    for every call. The session is created on first use.
+    """
+    with _sessions_lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[url] = session
+        return session
+
+
+class RedcapHTTPError(RedcapError):
+    """A response with an HTTP error status"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RedcapServerError(RedcapHTTPError):
+    """A server error (HTTP status 5xx), often caused by large requests"""
+
+
+class ClientMixin:
+    """A mixin for PyCap's API classes, adding streamed downloads
+
+    PyCap returns csv and xml exports as a single string, which means
+    that the entire response has to be held in memory. With this mixin,
+    calls which would return a string instead return an iterator over
+    chunks of bytes, read from the response as they arrive. Other
+    calls (e.g. json) are handled by PyCap's request logic as usual.
+
+    All requests are made with a session shared by API objects using
+    the same URL (see get_session).
+
+    Unless a timeout is given as a request keyword argument, the value
+    of the ``datalad.redcap.request-timeout`` configuration is used
+    (by default, requests do not time out).
+
+    If a rate limit is configured, every request waits for its turn
+    (see get_rate_limiter). The ``dataset`` keyword argument selects
+    the dataset whose configuration, and rate limit state, is used.
+
+    Requests failing for transient reasons (connection errors, HTTP
+    status 429, 502, 503, or 504) are retried, up to the number of
+    times given by ``datalad.redcap.retries`` (default: 3), with
+    exponentially growing, randomized delays starting around
+    ``datalad.redcap.retry-delay`` seconds (default: 1). The number of
+    retries and the total delay are counted in ``retries`` and
+    ``retry_wait``. For streamed responses, only the start of the
+    response is covered.
+
+    The mixin has to come before the PyCap class in the list of base
+    classes, so that its ``_call_api`` takes precedence.
+    """
+
+    # number of bytes to read from the response at a time
+    chunk_size = 1024 * 1024
+
+    def __init__(self, *args, dataset: Optional[Dataset] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        cfg = dataset.config if dataset is not None else datalad.cfg
+        timeout = cfg.get(TIMEOUT_VAR)
+        if timeout and "timeout" not in self._request_kwargs:
+            self._request_kwargs["timeout"] = float(timeout)
+        self._rate_limiter = get_rate_limiter(self.url, self.token, dataset)
+        self.max_retries = int(cfg.get(RETRIES_VAR, DEFAULT_RETRIES))
+        self.retry_delay = float(cfg.get(RETRY_DELAY_VAR, DEFAULT_RETRY_DELAY))
+        self.retries = 0
+        self.retry_wait = 0.0
+        self._retries_lock = Lock()
+
+    def _call_api(self, payload: Dict[str, Any], return_type: str, file=None):
+        attempt = 0
+        while True:
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            try:
+                return self._request(payload, return_type, file)
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_transient_error(e):
+                    raise
+                delay = _backoff_delay(attempt, self.retry_delay)
+                lgr.debug("API request failed (%s), retrying in %.1f s", e, delay)
+                with self._retries_lock:
+                    self.retries += 1
+                    self.retry_wait += delay
+                time.sleep(delay)
+                attempt += 1
+
+    def _request(self, payload: Dict[str, Any], return_type: str, file=None):
+        """Make a single API request"""
+        if return_type == "str" and file is None:
+            return self._stream_api(payload)
+
+        # same as PyCap's Base._call_api, but with the shared session,
+        # and checking the HTTP status before parsing the content
+        response = get_session(self.url).post(
+            self.url,
+            data=payload,
+            verify=self.verify_ssl,
+            files=file,
+            **self._request_kwargs,
+        )
+        if not response.ok:
+            raise _http_error(response.text, response.status_code)
+        return _parse_content(response.content, response.headers, payload, return_type)
+
+    def _stream_api(self, payload: Dict[str, Any]) -> Iterator[bytes]:
+        """Make a streamed POST request, and return an iterator over chunks
+
+        Errors reported by the server (HTTP error status, or an error
+        message in place of content) are raised as RedcapError before
+        returning, so that the caller does not need to inspect the
+        content. The response is closed once the iterator is exhausted.
+        """
+        response = get_session(self.url).post(
+            self.url,
+            data=payload,
+            verify=self.verify_ssl,
+            stream=True,
+            **self._request_kwargs,
+        )
+        if not response.ok:
+            # error messages are short, safe to read them whole
+            content = response.text
+            response.close()
+            raise _http_error(content, response.status_code)
+
+        chunks = response.iter_content(chunk_size=self.chunk_size)
+        first = next(chunks, b"")
+        if _is_error_message(first, payload.get("format")):
+            response.close()
+            raise RedcapError(first.decode(errors="replace"))
+
+        return _close_when_done(chain([first], chunks), response)
+
+
+class MyProjectInfo(ClientMixin, ProjectInfo):
+    """An extension of PyCap's ProjectInfo class with streamed xml export"""
+
+    def export_project_xml(
+        self,
+        metadata_only: bool = False,
+        files: bool = False,
+        survey_fields: bool = False,
+        dags: bool = False,
+    ):
+        """Export Project XML
+
+        PyCap's ProjectInfo class lacks a method for this export.
+        """
+
+        format_type = "xml"
+        payload = self._initialize_payload(
+            content="project_xml",
+            format_type=format_type,
+        )
+
+        payload["returnMetadataOnly"] = metadata_only
+        payload["exportFiles"] = files
+        payload["exportSurveyFields"] = survey_fields
+        payload["exportDataAccessGroups"] = dags
+
+        return_type = self._lookup_return_type(format_type, request_type="export")
+        response = self._call_api(payload, return_type)
+
+        return self._return_data(
+            response=response,
+            content="instrument",
+            format_type=format_type,
+            df_kwargs=None,
+        )
+
+
+class MyRecords(ClientMixin, Records):
+    """An extension of PyCap's Records class with streamed csv export
+
+    Contains additional methods to export records in batches
+    """
+
+    def export_record_ids(self) -> List[str]:
+        """Export a list of unique record IDs, in order of appearance
+
+        Only the record ID field is requested, so this is a cheap call
+        even for large projects. In longitudinal projects or projects
+        with repeating instruments, the same ID appears on several
+        rows, but is reported only once.
+        """
+        return list(dict.fromkeys(self.export_record_id_rows()))
+
+    def export_record_id_rows(self) -> List[str]:
+        """Export the record ID of every row, in order
+
+        In longitudinal projects or projects with repeating instruments,
+        there are several rows, and the same ID appears on each of them.
+        """
+        response = self.export_records(format_type="json", fields=[self.def_field])
+        return [row[self.def_field] for row in response]
+
+    def export_records_batched(
+        self, batch_size: int, jobs: int = 1, **kwargs
+    ) -> Iterator[bytes]:
+        """Export csv records in batches of up to a given number of records
+
+        The record IDs are listed first, and then records are exported
+        in batches, with one request per batch. Batches are stitched
+        together into a single csv, with the header of the first batch
+        only. Other keyword arguments are passed to ``export_records``.
+        Errors in listing record IDs are raised immediately, and
+        requests for batches are made as the returned iterator is
+        consumed. Each batch is read into memory before being passed on.
+
+        The batch size adapts to what the server can handle: a batch
+        which fails with a timeout or a server error is split in half,
+        and both halves are requested instead (down to single records).
+        After every few successful batches, the size is doubled again,
+        up to ``batch_size``.
+
+        With ``jobs`` greater than 1, up to that many batches are
+        requested at the same time, in a thread pool, and passed on in
+        the original order.
+        """
+        record_ids = self.export_record_ids()
+        if not record_ids:
+            # nothing to split, but we still want the csv header
+            return self.export_records(format_type="csv", **kwargs)
+        return self._iter_batches(record_ids, BatchSizer(batch_size), jobs, **kwargs)
+
+    def _iter_batches(
+        self, record_ids: List[str], sizer: "BatchSizer", jobs: int, **kwargs
+    ) -> Iterator[bytes]:
+        batches = sizer.batched(record_ids)
+        if jobs > 1:
+            responses = self._fetch_parallel(batches, sizer, jobs, **kwargs)
+        else:
+            responses = (self._fetch_batch(batch, sizer, **kwargs) for batch in batches)
+        for i, chunks in enumerate(responses):
+            yield from chunks if i == 0 else _drop_first_line(chunks)
+
+    def _fetch_batch(
+        self, batch: List[str], sizer: "BatchSizer", **kwargs
+    ) -> List[bytes]:
+        """Fetch a batch of records, splitting it on overload
+
+        On overload, the batch size is halved, and the batch is fetched
+        in pieces of the (current) batch size instead.
+        """
+        try:
+            chunks = self.export_records(format_type="csv", records=batch, **kwargs)
+            content = [b"".join(chunks)]
+        except Exception as e:
+            if len(batch) == 1 or not _is_overload_error(e):
+                raise
+            lgr.debug("Request for %d records failed (%s), splitting", len(batch), e)
+            sizer.shrink(len(batch) // 2)
+            content = []
+            while batch:
+                piece, batch = batch[: sizer.size], batch[sizer.size :]
+                chunks = self._fetch_batch(piece, sizer, **kwargs)
+                content.extend(_drop_first_line(chunks) if content else chunks)
+            return content
+        sizer.grow()
+        return content
+
+    def _fetch_parallel(
+        self, batches: Iterable[List[str]], sizer: "BatchSizer", jobs: int, **kwargs
+    ) -> Iterator[List[bytes]]:
+        """Fetch batches in a thread pool, yielding them in order
+
+        No more than ``jobs`` batches are submitted (or held in memory)
+        at any given time.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            try:
+                for batch in batches:
+                    if len(pending) >= jobs:
+                        yield pending.popleft().result()
+                    pending.append(
+                        executor.submit(self._fetch_batch, batch, sizer, **kwargs)
+                    )
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # on error, do not wait for batches that will not be used
+                for future in pending:
+                    future.cancel()
+
+
+class MyReports(ClientMixin, Reports):
+    """An extension of PyCap's Reports class with streamed csv export"""
+
+
+class MyInstruments(ClientMixin, Instruments):
+    """An extension of PyCap's Instruments class
+
+    Contains an additional method to export instruments names and labels
+    """
+
+    def export_instruments(self):
+        """Export instruments names and labels
+
+        PyCap's Instruments class has a field_names property, but lacks
+        a method to return matching labels (human-readable). This method
+        does that in a simplified way (only supports json format, does not
+        support arms).
+        """
+        format_type = "json"  # constant, for now
+        payload = self._initialize_payload(
+            content="instrument",
+            format_type=format_type,
+        )
+        return_type = self._lookup_return_type(format_type, request_type="export")
+        response = self._call_api(payload, return_type)
+
+        return self._return_data(
+            response=response,
+            content="instrument",
+            format_type=format_type,
+            df_kwargs=None,
+        )
+
+
+class MyMetadata(ClientMixin, Metadata):
+    """An extension of PyCap's Metadata class"""
+
+
+class BatchSizer:
+    """Keep track of a batch size, which adapts to server responses
+
+    The size starts at (and never exceeds) ``max_size``. It is reduced
+    after failed requests (see ``shrink``), and doubled after
+    ``grow_after`` successful requests in a row. Shared by all threads
+    fetching batches of one export.
+    """
+
+    def __init__(self, max_size: int, grow_after: int = 4):
+        self.max_size = max_size
+        self.size = max_size
+        self.grow_after = grow_after
+        self._successes = 0
+        self._lock = Lock()
+
+    def shrink(self, size: int):
+        """Use no more than the given size for following batches"""
+        with self._lock:
+            self.size = max(1, min(self.size, size))
+            self._successes = 0
+
+    def grow(self):
+        """Count a successful request, and grow the size if it is time"""
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.grow_after and self.size < self.max_size:
+                self.size = min(self.max_size, self.size * 2)
+                self._successes = 0
+
+    def batched(self, items: Iterable[str]) -> Iterator[List[str]]:
+        """Split items into lists, each of the size current at the time"""
+        it = iter(items)
+        while batch := list(islice(it, self.size)):
+            yield batch
+
+
+def _drop_first_line(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield from chunks, skipping everything up to the first newline
+
+    Used to drop csv headers. Field names in REDCap can not contain
+    newlines, so the header always ends at the first one.
+    """
+    header_done = False
+    for chunk in chunks:
+        if not header_done:
+            newline = chunk.find(b"\n")
+            if newline == -1:
+                continue
+            chunk = chunk[newline + 1 :]
+            header_done = True
+        if chunk:
+            yield chunk
+
+
+def _is_error_message(chunk: bytes, format_type: Optional[str]) -> bool:
+    """Tell if the beginning of a response is an error message
+
+    Mirrors the checks done by PyCap on complete responses.
+    """
+    if format_type == "csv":
+        return chunk.lower().startswith(b"error:")
+    return b"<error>" in chunk.lower()
+
+
+def _http_error(message: str, status_code: int) -> RedcapHTTPError:
+    """Return the error to raise for a response with an HTTP error status"""
+    if status_code >= 500:
+        return RedcapServerError(message, status_code)
+    return RedcapHTTPError(message, status_code)
+
+
+def _parse_content(
+    content: bytes, headers: Any, payload: Dict[str, Any], return_type: str
+) -> Any:
+    """Return the content of a successful response like PyCap would
+
+    Mirrors PyCap's _RCRequest: json is decoded, file downloads are
+    returned as bytes together with the headers, and error messages
+    sent in place of content are raised as RedcapError.
+    """
+    if return_type == "empty_json":
+        return [{}]
+    fmt = payload.get("returnFormat", payload.get("format"))
+    if fmt == "json" and return_type != "file_map":
+        data = json.loads(content)
+        if isinstance(data, dict) and "error" in data:
+            raise RedcapError(data)
+        return data
+    if fmt != "json" and _is_error_message(content, fmt):
+        raise RedcapError(content.decode(errors="replace"))
+    if return_type == "file_map":
+        return content, headers
+    return content.decode()
+
+
+def _is_overload_error(e: Exception) -> bool:
+    """Tell if an error suggests that a request was too large to handle
+
+    These are server errors, and timeouts waiting for the server to
+    start or continue sending the response.
+    """
+    if isinstance(e, (RedcapServerError, requests.exceptions.Timeout)):
+        return True
+    # read timeouts during streaming are raised as connection errors
+    return isinstance(e, requests.exceptions.ConnectionError) and any(
+        isinstance(arg, ReadTimeoutError) for arg in e.args
+    )
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """Tell if an error is likely to go away when trying again
+
+    These are connection errors (but not read timeouts, which rather
+    suggest overload), and some HTTP error statuses.
+    """
+    if isinstance(e, RedcapHTTPError):
+        return e.status_code in TRANSIENT_STATUS_CODES
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    return isinstance(
+        e, requests.exceptions.ConnectionError
+    ) and not _is_overload_error(e)
+
+
+def _backoff_delay(attempt: int, base: float) -> float:
+    """Return a randomized delay, doubling with every attempt
+
+    The delay is between half and all of ``base * 2**attempt`` (capped
+    at MAX_RETRY_DELAY), so that clients failing at the same time do not
+    all retry at the same time.
+    """
+    delay = min(MAX_RETRY_DELAY, base * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _close_when_done(chunks: Iterator[bytes], response) -> Iterator[bytes]:
+    """Yield from chunks, closing the response afterwards"""
+    try:
+        yield from chunks
+    finally:
+        response.close()
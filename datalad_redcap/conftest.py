@@ -3,6 +3,24 @@ import pytest
 from datalad.conftest import setup_package
 from datalad_next.credman import CredentialManager
 
+from datalad_redcap.utils import invalidate_credentials
+
+
+@pytest.fixture(autouse=True)
+def metadata_cache(tmp_path, monkeypatch):
+    """Use a separate metadata cache directory for every test"""
+    cache_dir = tmp_path / "redcap-cache"
+    monkeypatch.setattr("datalad_redcap.cache.get_cache_dir", lambda: cache_dir)
+    yield cache_dir
+
+
+@pytest.fixture(autouse=True)
+def no_cached_credentials():
+    """Do not let tests see credentials cached by other tests"""
+    invalidate_credentials()
+    yield
+    invalidate_credentials()
+
 
 @pytest.fixture
 def api_url():
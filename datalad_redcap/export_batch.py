@@ -0,0 +1,544 @@
+"""Run several exports defined in a manifest"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import (
+    ExitStack,
+    nullcontext,
+)
+from itertools import zip_longest
+import json
+import logging
+import os
+from pathlib import Path
+from threading import BoundedSemaphore
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urlparse
+
+from datalad.distribution.dataset import Dataset
+from datalad.interface.common_opts import (
+    nosave_opt,
+    save_message_opt,
+)
+from datalad_next.commands import (
+    EnsureCommandParameterization,
+    Parameter,
+    ValidatedInterface,
+    build_doc,
+    datasetmethod,
+    eval_results,
+    get_status_dict,
+)
+from datalad_next.constraints import (
+    EnsureBool,
+    EnsureInt,
+    EnsureListOf,
+    EnsurePath,
+    EnsureRange,
+    EnsureStr,
+    EnsureURL,
+)
+from datalad_next.constraints.dataset import (
+    DatasetParameter,
+    EnsureDataset,
+)
+from datalad_next.constraints.exceptions import ConstraintError
+from datalad_next.exceptions import CapturedException
+from datalad_next.utils import CredentialManager
+
+from .export_form import write_form
+from .export_project_xml import write_project_xml
+from .export_report import write_report
+from .metrics import (
+    export_labels,
+    export_values,
+    write_metrics,
+)
+from .stats import CommandStats
+from .utils import (
+    check_ok_to_edit_many,
+    obtain_credential,
+    update_credentials,
+)
+
+__docformat__ = "restructuredtext"
+lgr = logging.getLogger("datalad.redcap.export_batch")
+
+# export types: result action, api class (name in .client, imported
+# when needed), write function, and the options (other than outfile)
+# accepted from the manifest, with the constraints of the corresponding
+# export command
+EXPORT_TYPES = {
+    "form": (
+        "export_redcap_form",
+        "MyRecords",
+        write_form,
+        dict(
+            forms=EnsureListOf(str),
+            survey_fields=EnsureBool(),
+            batch_size=EnsureInt() & EnsureRange(min=1),
+            incremental=EnsureBool(),
+        ),
+    ),
+    "report": (
+        "export_redcap_report",
+        "MyReports",
+        write_report,
+        dict(report=EnsureStr()),
+    ),
+    "project_xml": (
+        "export_redcap_project_xml",
+        "MyProjectInfo",
+        write_project_xml,
+        dict(metadata_only=EnsureBool(), survey_fields=EnsureBool()),
+    ),
+}
+
+# options which have to be given in the manifest, per export type
+REQUIRED_OPTIONS = {
+    "form": ("forms",),
+    "report": ("report",),
+    "project_xml": (),
+}
+
+
+@build_doc
+class ExportBatch(ValidatedInterface):
+    """Run several exports defined in a manifest, and save them together
+
+    The manifest is a JSON or YAML (requires PyYAML) file, which lists
+    the exports to perform from one or more REDCap projects. Exports
+    are performed at the same time (see --jobs and --jobs-per-host),
+    using one connection pool per API URL, and all output files are
+    saved with a single save call.
+
+    The manifest contains the API URL, optionally the name of a
+    credential, and a list of exports. Each export has a ``type``
+    (``form``, ``report``, or ``project_xml``) and an ``outfile``
+    (relative to the dataset), plus options of the corresponding
+    export command: ``forms`` (list of form names, required),
+    ``survey_fields``, ``batch_size`` and ``incremental`` for forms;
+    ``report`` (report ID, required) for reports; ``metadata_only`` and
+    ``survey_fields`` for project XML. Options are checked with the same
+    constraints as the arguments of the export commands, and exports
+    with invalid options are reported as errors. Example (JSON)::
+
+      {
+        "url": "https://redcap.example.com/api/",
+        "credential": "redcap-project",
+        "exports": [
+          {"type": "form", "forms": ["demographics"], "outfile": "demo.csv"},
+          {"type": "report", "report": "1234", "outfile": "report.csv"},
+          {"type": "project_xml", "outfile": "project.xml"}
+        ]
+      }
+
+    To export from several projects, possibly on different REDCap
+    servers, the manifest contains a list of ``projects`` instead, each
+    with its own ``url``, ``credential`` and ``exports``. A project can
+    also name a ``dataset``, a subdataset (relative to the reference
+    dataset) to which its output files are written. Example (YAML)::
+
+      projects:
+        - url: https://redcap.example.com/api/
+          credential: redcap-study-a
+          exports:
+            - {type: form, forms: [demographics], outfile: a/demo.csv}
+        - url: https://redcap.example.org/api/
+          credential: redcap-study-b
+          dataset: study-b
+          exports:
+            - {type: report, report: "1234", outfile: report.csv}
+
+    A token is obtained for every project (from its credential, or by
+    the API URL) before any export is started. An export writing to the
+    same output file as an earlier one in the manifest is not performed,
+    and reported as an error.
+
+    One result is reported for every export. Failed exports do not
+    prevent others from being performed and saved. The timings in the
+    results include the time spent waiting for the --jobs-per-host
+    limit (``wait``). The status check and credential lookup are done
+    once per project, and their timings are reported with the first
+    export of the project; the time to save all files is reported with
+    the first saved export.
+    """
+
+    _params_ = dict(
+        manifest=Parameter(
+            args=("manifest",),
+            doc="""path to the manifest file. Files with a .yaml or .yml
+            extension are read as YAML, all others as JSON.""",
+        ),
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar="PATH",
+            doc="""the dataset in which the output files will be saved.
+            The output file paths in the manifest will be interpreted as
+            being relative to this dataset.  If no dataset is given, it
+            will be identified based on the working directory.""",
+        ),
+        credential=Parameter(
+            args=("--credential",),
+            metavar="name",
+            doc="""name of the credential providing a token to be used for
+            authorization, for projects which do not name a credential
+            in the manifest. If a match for the name is found, it will
+            be used; otherwise the user will be prompted and the
+            credential will be saved. If the name is not provided, the
+            last-used credential matching the API url will be used if
+            present; otherwise the user will be prompted and the
+            credential will be saved under a default name.""",
+        ),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of exports to perform at the same time.""",
+        ),
+        jobs_per_host=Parameter(
+            args=("--jobs-per-host",),
+            metavar="NJOBS",
+            doc="""number of exports to perform at the same time from any
+            one REDCap server. By default, only --jobs is a limit.""",
+        ),
+        metrics_file=Parameter(
+            args=("--metrics-file",),
+            metavar="PATH",
+            doc="""write metrics of every export (duration, bytes and rows
+            received, retries, and success) to this file, in the
+            OpenMetrics text format, labelled with the API URL, export
+            type, form names or report ID, and output file. Meant for
+            monitoring scheduled exports, e.g. with the textfile collector
+            of Prometheus' node_exporter. The file is replaced once all
+            exports are done.""",
+        ),
+        message=save_message_opt,
+        save=nosave_opt,
+    )
+
+    _validator_ = EnsureCommandParameterization(
+        dict(
+            manifest=EnsurePath(lexists=True),
+            dataset=EnsureDataset(installed=True, purpose="export REDCap data"),
+            credential=EnsureStr(),
+            jobs=EnsureInt() & EnsureRange(min=1),
+            jobs_per_host=EnsureInt() & EnsureRange(min=1),
+            metrics_file=EnsurePath(),
+            message=EnsureStr(),
+            save=EnsureBool(),
+        ),
+        validate_defaults=("dataset",),
+    )
+
+    @staticmethod
+    @datasetmethod(name="export_redcap_batch")
+    @eval_results
+    def __call__(
+        manifest: Path,
+        dataset: Optional[DatasetParameter] = None,
+        credential: Optional[str] = None,
+        jobs: int = 4,
+        jobs_per_host: Optional[int] = None,
+        metrics_file: Optional[Path] = None,
+        message: Optional[str] = None,
+        save: bool = True,
+    ):
+
+        ds = dataset.ds
+
+        spec = read_manifest(manifest)
+        projects = spec["projects"] if "projects" in spec else [spec]
+        if not isinstance(projects, list) or not all(
+            isinstance(p, dict) for p in projects
+        ):
+            raise ValueError(
+                f"Projects in manifest {manifest} are not a list of mappings"
+            )
+
+        # check all projects and exports before starting any of them
+        tasks = []
+        project_stats = {}
+        # metrics of exports which failed these checks
+        rejected = []
+        # output files of accepted exports, in all target datasets
+        outfiles = set()
+        for idx, project in enumerate(projects):
+            url = EnsureURL(required=["scheme", "netloc", "path"])(project.get("url"))
+            target = ds
+            if project.get("dataset") is not None:
+                target = Dataset(ds.pathobj / project["dataset"])
+                if not target.is_installed():
+                    raise ValueError(
+                        f"Dataset {project['dataset']} of {url} is not installed"
+                    )
+            exports = []
+            for export in project.get("exports", []):
+                options, error = _check_export(export)
+                if error is not None:
+                    outfile = (
+                        target.pathobj / export["outfile"]
+                        if isinstance(export, dict) and "outfile" in export
+                        else None
+                    )
+                    rejected.append(_export_metrics(url, export, outfile, ds))
+                    yield get_status_dict(
+                        action="export_redcap_batch",
+                        status="error",
+                        message=error,
+                    )
+                    continue
+                outfile = target.pathobj / export["outfile"]
+                # concurrent exports to the same file would overwrite
+                # each other, only the first one is performed
+                if Path(os.path.normpath(outfile)) in outfiles:
+                    rejected.append(_export_metrics(url, export, outfile, ds))
+                    yield get_status_dict(
+                        action="export_redcap_batch",
+                        path=outfile,
+                        status="error",
+                        message="Output file is written by another export",
+                    )
+                    continue
+                outfiles.add(Path(os.path.normpath(outfile)))
+                exports.append((export, options, outfile))
+            # check the status of all output files at once, timings of
+            # steps shared by the exports of a project go to the first
+            project_stats[idx] = stats = CommandStats()
+            with stats.phase("status"):
+                decisions = check_ok_to_edit_many([o for *_, o in exports], target)
+            for (export, options, outfile), (ok_to_edit, _) in zip(
+                exports, decisions
+            ):
+                if not ok_to_edit:
+                    rejected.append(_export_metrics(url, export, outfile, ds))
+                    yield get_status_dict(
+                        action="export_redcap_batch",
+                        path=outfile,
+                        status="error",
+                        message=(
+                            "Output file status is not clean or it is not "
+                            "directly under the reference dataset."
+                        ),
+                    )
+                    continue
+                tasks.append((idx, url, target, export, options, outfile, stats))
+                stats = CommandStats()
+        if not tasks:
+            if metrics_file is not None and rejected:
+                write_metrics(metrics_file, rejected)
+            return
+
+        # determine a token for every project with something to export,
+        # before starting, as obtaining one may require user interaction
+        credman = CredentialManager(ds.config)
+        credentials = {}
+        for idx in dict.fromkeys(t[0] for t in tasks):
+            project = projects[idx]
+            with project_stats[idx].phase("credentials"):
+                credentials[idx] = obtain_credential(
+                    credman,
+                    project["url"],
+                    project.get("credential", credential),
+                    ds=ds,
+                )
+
+        # limit the number of concurrent exports from any one server
+        host_limits = {}
+        if jobs_per_host is not None:
+            host_limits = {
+                urlparse(t[1]).netloc: BoundedSemaphore(jobs_per_host) for t in tasks
+            }
+
+        def run_export(
+            api,
+            target: Dataset,
+            export: dict,
+            options: dict,
+            outfile: Path,
+            stats: CommandStats,
+        ) -> bool:
+            write = EXPORT_TYPES[export["type"]][2]
+            with ExitStack() as stack:
+                with stats.phase("wait"):
+                    stack.enter_context(
+                        host_limits.get(urlparse(api.url).netloc, nullcontext())
+                    )
+                return write(api, target, outfile, stats=stats, **options)
+
+        # perform the exports, api objects share connections (per url)
+        from . import client
+
+        results = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            for task in _interleave_by_host(tasks):
+                idx, url, target, export, options, outfile, stats = task
+                api = getattr(client, EXPORT_TYPES[export["type"]][1])(
+                    url=url, token=credentials[idx][1]["secret"], dataset=ds
+                )
+                future = executor.submit(
+                    run_export, api, target, export, options, outfile, stats
+                )
+                futures.append((idx, api, export, outfile, stats, future))
+            for idx, api, export, outfile, stats, future in futures:
+                res = get_status_dict(
+                    action=EXPORT_TYPES[export["type"]][0],
+                    path=outfile,
+                )
+                try:
+                    changed = future.result()
+                except Exception as e:
+                    ce = CapturedException(e)
+                    res.update(status="error", message=str(ce), exception=ce)
+                else:
+                    res.update(
+                        status="ok" if changed else "notneeded",
+                        message=None if changed else "exported content did not change",
+                    )
+                res.update(retries=api.retries, retry_wait=api.retry_wait)
+                results.append((idx, res, stats, export))
+
+        for idx in dict.fromkeys(
+            i for i, r, _, _ in results if r["status"] in ("ok", "notneeded")
+        ):
+            # at least one query went well, store or update credentials
+            update_credentials(credman, *credentials[idx])
+
+        # save all changes (also in subdatasets) at once
+        changed = [(r, stats) for _, r, stats, _ in results if r["status"] == "ok"]
+        changed_paths = [Path(r["path"]) for r, _ in changed]
+        if changed_paths and save:
+            with changed[0][1].phase("save"):
+                ds.save(
+                    message=message
+                    if message is not None
+                    else _write_commit_message(changed_paths, ds.pathobj),
+                    path=changed_paths,
+                )
+
+        if metrics_file is not None:
+            write_metrics(
+                metrics_file,
+                rejected
+                + [
+                    _export_metrics(
+                        projects[idx]["url"],
+                        export,
+                        Path(res["path"]),
+                        ds,
+                        stats,
+                        res["retries"],
+                        res["status"] != "error",
+                    )
+                    for idx, res, stats, export in results
+                ],
+            )
+
+        for _, res, stats, _ in results:
+            res.update(stats.result_props())
+            yield res
+
+
+def read_manifest(path: Path) -> dict:
+    """Read an export manifest from a JSON or YAML file"""
+    with open(path) as f:
+        if path.suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as e:
+                raise RuntimeError(
+                    "Reading YAML manifests requires PyYAML to be installed"
+                ) from e
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise ValueError(f"Manifest {path} does not contain a mapping")
+    return spec
+
+
+def _check_export(export: dict) -> Tuple[dict, Optional[str]]:
+    """Validate an export spec
+
+    Returns the options of the export (other than type and outfile),
+    validated with the constraints of the export command, and None, or
+    an empty dict and an error message if the spec is invalid.
+    """
+    if not isinstance(export, dict):
+        return {}, f"Export specification is not a mapping: {export!r}"
+    if export.get("type") not in EXPORT_TYPES:
+        return {}, f"Unknown export type: {export.get('type')!r}"
+    missing = [
+        k for k in ("outfile",) + REQUIRED_OPTIONS[export["type"]] if k not in export
+    ]
+    if missing:
+        return {}, f"Missing export options: {', '.join(missing)}"
+    constraints = EXPORT_TYPES[export["type"]][3]
+    unknown = set(export) - {"type", "outfile"} - set(constraints)
+    if unknown:
+        return {}, f"Unknown export options: {', '.join(sorted(unknown))}"
+    options = {}
+    for k, constraint in constraints.items():
+        if k not in export:
+            continue
+        # a string would pass as a list of its characters
+        if isinstance(constraint, EnsureListOf) and not isinstance(export[k], list):
+            return {}, f"Invalid export option {k}={export[k]!r}: must be a list"
+        try:
+            options[k] = constraint(export[k])
+        except ConstraintError as e:
+            return {}, f"Invalid export option {k}={export[k]!r}: {e}"
+    return options, None
+
+
+def _export_metrics(
+    url: str,
+    export: dict,
+    outfile: Optional[Path],
+    ds: Dataset,
+    stats: Optional[CommandStats] = None,
+    retries: int = 0,
+    success: bool = False,
+) -> Tuple[Dict[str, str], Dict[str, Optional[float]]]:
+    """Return labels and values of the metrics of an export
+
+    The export spec may be invalid, its labels are then incomplete.
+    Without stats, the export is taken to have failed before starting.
+    """
+    spec = export if isinstance(export, dict) else {}
+    export_type = spec.get("type")
+    name = None
+    if export_type == "form" and isinstance(spec.get("forms"), list):
+        name = ",".join(str(f) for f in spec["forms"])
+    elif export_type == "report" and "report" in spec:
+        name = str(spec["report"])
+    labels = export_labels(url, str(export_type), name, outfile, ds)
+    return labels, export_values(stats or CommandStats(), retries, success)
+
+
+def _interleave_by_host(tasks: List[tuple]) -> List[tuple]:
+    """Order export tasks round-robin across API hosts
+
+    Tasks (with the API URL as their second item) are submitted to the
+    thread pool in this order, so that workers waiting for the limit of
+    one host do not hold up exports from other hosts listed later.
+    """
+    by_host = {}
+    for task in tasks:
+        by_host.setdefault(urlparse(task[1]).netloc, []).append(task)
+    return [
+        task
+        for group in zip_longest(*by_host.values())
+        for task in group
+        if task is not None
+    ]
+
+
+def _write_commit_message(paths: List[Path], root: Path) -> str:
+    """Return a formatted commit message that lists exported files"""
+    files = "\n".join(f"- {p.relative_to(root).as_posix()}" for p in paths)
+    return f"Export REDCap data\n\nExported files:\n{files}"
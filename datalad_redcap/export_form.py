@@ -1,15 +1,25 @@
 """Export one or multiple forms"""
 
+import csv
+from datetime import (
+    datetime,
+    timedelta,
+)
+from io import StringIO
 import logging
 from pathlib import Path
 import textwrap
 from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Tuple,
 )
 
-from redcap.methods.records import Records
-
+from datalad.distribution.dataset import Dataset
 from datalad.interface.common_opts import (
     nosave_opt,
     save_message_opt,
@@ -25,8 +35,10 @@ from datalad_next.commands import (
 )
 from datalad_next.constraints import (
     EnsureBool,
+    EnsureInt,
     EnsureListOf,
     EnsurePath,
+    EnsureRange,
     EnsureStr,
     EnsureURL,
     DatasetParameter,
@@ -36,14 +48,50 @@ from datalad_next.constraints.dataset import (
 )
 from datalad_next.utils import CredentialManager
 
+from .plan import (
+    format_plan,
+    get_metadata,
+    plan_form_export,
+)
+from .metrics import (
+    export_labels,
+    recorded_export,
+    write_export_metrics,
+)
+from .stats import CommandStats
 from .utils import (
     update_credentials,
     check_ok_to_edit,
+    write_if_changed,
+    obtain_credential,
 )
 
+if TYPE_CHECKING:
+    from .client import MyRecords
+
 __docformat__ = "restructuredtext"
 lgr = logging.getLogger("datalad.redcap.export_form")
 
+# format of date range parameters in REDCap's API
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# configuration item with the time (in seconds) by which incremental
+# exports reach back before the start of the previous one; REDCap reads
+# the date range in the server's local time, and time zones can differ
+# by up to 26 hours, so the default covers any offset of the local clock
+OVERLAP_VAR = "datalad.redcap.incremental-overlap"
+DEFAULT_OVERLAP = 2 * 24 * 3600
+
+# for reading csv files with their original line endings and encoding
+CSV_OPEN_KWARGS = dict(encoding="utf-8", errors="surrogateescape", newline="")
+
+# columns which, in addition to record ID, identify a row of a csv export
+KEY_COLUMNS = (
+    "redcap_event_name",
+    "redcap_repeat_instrument",
+    "redcap_repeat_instance",
+)
+
 
 @build_doc
 class ExportForm(ValidatedInterface):
@@ -94,6 +142,66 @@ class ExportForm(ValidatedInterface):
             present; otherwise the user will be prompted and the
             credential will be saved under a default name.""",
         ),
+        batch_size=Parameter(
+            args=("--batch-size",),
+            metavar="N",
+            doc="""export records in batches of up to N records, with one
+            request per batch. Record IDs are listed first, and the
+            batches are combined into a single csv file. This can help
+            with projects too large to be exported in a single request
+            (which may time out or exceed the server's memory limits).
+            Batches which fail with a timeout or a server error are split
+            in half and requested again, and the batch size grows back
+            (up to N) after successful requests. The time to wait for the
+            server can be set with the datalad.redcap.request-timeout
+            configuration (in seconds). By default, all records are
+            exported with one request.""",
+        ),
+        jobs=Parameter(
+            args=("-J", "--jobs"),
+            metavar="NJOBS",
+            doc="""number of batches to request at the same time. Only
+            used together with --batch-size. Batches are still written
+            in order, but up to NJOBS of them may be held in memory at
+            once.""",
+        ),
+        incremental=Parameter(
+            args=("--incremental",),
+            action="store_true",
+            doc="""only request records created or modified since the last
+            incremental export to the same file, and merge them into the
+            existing file, replacing rows with the same record ID, event
+            and repeat instance. The time of each incremental export is
+            stored in the local configuration of the dataset. If there
+            was no previous export, or the exported columns changed, all
+            records are exported. Note that records deleted in REDCap are
+            not removed from the file. As the time is taken from the local
+            clock, but REDCap filters by the server's time, each export
+            also requests records modified during an overlap before the
+            previous one started (rows requested again are replaced, not
+            duplicated). The overlap is set in seconds with the
+            datalad.redcap.incremental-overlap configuration (default: 2
+            days, enough for any time zone difference).""",
+        ),
+        dry_run=Parameter(
+            args=("--dry-run",),
+            action="store_true",
+            doc="""only estimate the size of the export (number of rows and
+            columns, bytes, and requests), and recommend a batch size for
+            large exports, using the list of record IDs and the project
+            metadata. Nothing is written to the dataset.""",
+        ),
+        metrics_file=Parameter(
+            args=("--metrics-file",),
+            metavar="PATH",
+            doc="""write metrics of the export (duration, bytes and rows
+            received, retries, and success) to this file, in the
+            OpenMetrics text format, labelled with the API URL, form names,
+            and output file. Meant for monitoring scheduled exports, e.g.
+            with the textfile collector of Prometheus' node_exporter. The
+            file is replaced after every export, also if it failed. Not
+            written with --dry-run.""",
+        ),
         message=save_message_opt,
         save=nosave_opt,
     )
@@ -106,6 +214,11 @@ class ExportForm(ValidatedInterface):
             dataset=EnsureDataset(installed=True, purpose="export REDCap form"),
             survey_fields=EnsureBool(),
             credential=EnsureStr(),
+            batch_size=EnsureInt() & EnsureRange(min=1),
+            jobs=EnsureInt() & EnsureRange(min=1),
+            incremental=EnsureBool(),
+            dry_run=EnsureBool(),
+            metrics_file=EnsurePath(),
             message=EnsureStr(),
             save=EnsureBool(),
         ),
@@ -123,15 +236,27 @@ class ExportForm(ValidatedInterface):
         dataset: Optional[DatasetParameter] = None,
         survey_fields: bool = True,
         credential: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        jobs: int = 1,
+        incremental: bool = False,
+        dry_run: bool = False,
+        metrics_file: Optional[Path] = None,
         message: Optional[str] = None,
         save: bool = True,
     ):
 
         ds = dataset.ds
+        stats = CommandStats()
+        labels = export_labels(url, "form", ",".join(forms), outfile, ds)
+        # a dry run is not an export worth recording
+        if dry_run:
+            metrics_file = None
 
         # refuse to operate if target file is outside the dataset or not clean
-        ok_to_edit, unlock = check_ok_to_edit(outfile, ds)
+        with stats.phase("status"):
+            ok_to_edit, _ = check_ok_to_edit(outfile, ds)
         if not ok_to_edit:
+            write_export_metrics(metrics_file, labels, stats, 0, False)
             yield get_status_dict(
                 action="export_redcap_form",
                 path=outfile,
@@ -143,62 +268,258 @@ class ExportForm(ValidatedInterface):
             )
             return
 
-        # determine a token
-        credman = CredentialManager(ds.config)
-        credname, credprops = credman.obtain(
-            name=credential,
-            prompt="A token is required to access the REDCap project API",
-            type_hint="token",
-            query_props={"realm": url},
-            expected_props=("secret",),
-        )
+        with recorded_export(metrics_file, labels, stats) as record:
+            # determine a token
+            credman = CredentialManager(ds.config)
+            with stats.phase("credentials"):
+                credname, credprops = obtain_credential(credman, url, credential, ds=ds)
 
-        # create an api object
-        api = Records(
-            url=url,
-            token=credprops["secret"],
-        )
+            # create an api object
+            from .client import MyRecords
 
-        # perform the api query
-        # for csv format, outputs result as string
-        # raises RedcapError if token or form name are incorrect
-        response = api.export_records(
-            format_type="csv",
-            forms=forms,
-            export_survey_fields=survey_fields,
-        )
+            api = record.api = MyRecords(
+                url=url,
+                token=credprops["secret"],
+                dataset=ds,
+            )
 
-        # query went well, store or update credentials
-        update_credentials(credman, credname, credprops)
+            if dry_run:
+                with stats.phase("request"):
+                    plan = plan_form_export(
+                        api,
+                        get_metadata(url, credprops["secret"], dataset=ds),
+                        forms,
+                        survey_fields=survey_fields,
+                        batch_size=batch_size,
+                    )
+            else:
+                # perform the api query and write contents, unless unchanged
+                # raises RedcapError if token or form name are incorrect
+                changed = write_form(
+                    api,
+                    ds,
+                    outfile,
+                    forms,
+                    survey_fields=survey_fields,
+                    batch_size=batch_size,
+                    jobs=jobs,
+                    incremental=incremental,
+                    stats=stats,
+                )
 
-        # unlock the file if needed, and write contents
-        if unlock:
-            yield from ds.unlock(
-                outfile, result_renderer="disabled", return_type="generator"
-            )
-        with open(outfile, "wt") as f:
-            f.write(response)
-
-        # save changes in the dataset
-        if save:
-            ds.save(
-                message=message
-                if message is not None
-                else _write_commit_message(forms),
+            # query went well, store or update credentials
+            update_credentials(credman, credname, credprops)
+
+            # save changes in the dataset
+            if not dry_run and changed and save:
+                with stats.phase("save"):
+                    ds.save(
+                        message=message
+                        if message is not None
+                        else _write_commit_message(forms),
+                        path=outfile,
+                    )
+
+        if dry_run:
+            yield get_status_dict(
+                action="export_redcap_form",
                 path=outfile,
+                status="ok",
+                message=format_plan(plan),
+                plan=plan,
+                **stats.result_props(),
             )
+            return
 
         # yield successful result if we made it to here
         yield get_status_dict(
             action="export_redcap_form",
             path=outfile,
-            status="ok",
+            status="ok" if changed else "notneeded",
+            message=None if changed else "exported content did not change",
+            retries=api.retries,
+            retry_wait=api.retry_wait,
+            **stats.result_props(),
         )
 
 
+def write_form(
+    api: "MyRecords",
+    ds: Dataset,
+    outfile: Path,
+    forms: List[str],
+    survey_fields: bool = True,
+    batch_size: Optional[int] = None,
+    jobs: int = 1,
+    incremental: bool = False,
+    stats: Optional[CommandStats] = None,
+) -> bool:
+    """Export records from forms into a csv file, unless unchanged
+
+    Performs the API request(s), and writes the output file with
+    write_if_changed, without saving. See ExportForm for the meaning of
+    the options. If given, ``stats`` records the request, download and
+    write phases, and the bytes and rows received. Returns True if the
+    file was written.
+    """
+    if stats is None:
+        stats = CommandStats()
+
+    # in incremental mode, find out when the last export was done
+    lastexport_var = _lastexport_var(outfile, ds)
+    last_export = (
+        ds.config.get(lastexport_var) if incremental and outfile.exists() else None
+    )
+    export_started = datetime.now()
+
+    # for csv format, outputs an iterator over chunks of the response
+    if last_export is not None:
+        with stats.phase("request"):
+            response = api.export_records(
+                format_type="csv",
+                forms=forms,
+                export_survey_fields=survey_fields,
+                date_begin=datetime.strptime(last_export, DATE_FORMAT),
+            )
+        # merge the changes with existing content
+        merged = _merge_csv(outfile, b"".join(stats.count(response, csv=True)))
+        if merged is None:
+            lgr.info("Exported columns changed, exporting all records")
+            with stats.phase("request"):
+                response = _export_all(api, forms, survey_fields, batch_size, jobs)
+            response = stats.count(response, csv=True)
+        else:
+            response = merged
+    else:
+        with stats.phase("request"):
+            response = _export_all(api, forms, survey_fields, batch_size, jobs)
+        response = stats.count(response, csv=True)
+
+    with stats.phase("write"):
+        changed = write_if_changed(response, outfile, ds, label="Downloading form")
+
+    # remember when this export started, for the next incremental one,
+    # reaching back by the overlap to allow for a different server clock
+    if incremental:
+        overlap = float(ds.config.get(OVERLAP_VAR, DEFAULT_OVERLAP))
+        ds.config.set(
+            lastexport_var,
+            (export_started - timedelta(seconds=overlap)).strftime(DATE_FORMAT),
+            scope="local",
+        )
+    return changed
+
+
 def _write_commit_message(which_forms: List[str]) -> str:
     """Return a formatted commit message that includes form names"""
     forms = ", ".join(which_forms)
     header = "Export REDCap forms"
     body = "\n".join(textwrap.wrap(f"Contains the following forms: {forms}."))
     return header + "\n\n" + body
+
+
+def _export_all(
+    api: "MyRecords",
+    forms: List[str],
+    survey_fields: bool,
+    batch_size: Optional[int],
+    jobs: int,
+) -> Iterator[bytes]:
+    """Export all records of the forms, in batches if requested"""
+    if batch_size is None:
+        return api.export_records(
+            format_type="csv",
+            forms=forms,
+            export_survey_fields=survey_fields,
+        )
+    # batches are requested as the response is consumed
+    return api.export_records_batched(
+        batch_size,
+        jobs=jobs,
+        forms=forms,
+        export_survey_fields=survey_fields,
+    )
+
+
+def _lastexport_var(outfile: Path, ds: Dataset) -> str:
+    """Return the name of the config variable with the last export time"""
+    relpath = outfile.relative_to(ds.pathobj).as_posix()
+    return f"datalad.redcap-export.{relpath}.lastexport"
+
+
+def _read_csv_rows(lines: Iterable[str]) -> Iterator[Tuple[List[str], str]]:
+    """Parse csv lines, yielding each row together with its raw text
+
+    Keeping the raw text allows writing rows back exactly as they were
+    received from the server, even if a value spans several lines.
+    """
+    consumed = []
+
+    def recorded(lines):
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    for row in csv.reader(recorded(lines)):
+        raw = "".join(consumed)
+        consumed.clear()
+        yield row, raw if raw.endswith("\n") else raw + "\n"
+
+
+def _key_columns(header: List[str]) -> List[int]:
+    """Return indices of columns identifying a row
+
+    The record ID is always in the first column, and the other key
+    columns are present depending on project setup.
+    """
+    return [0] + [header.index(c) for c in KEY_COLUMNS if c in header]
+
+
+def _merge_csv(filepath: Path, delta: bytes) -> Optional[Iterator[bytes]]:
+    """Merge exported rows into the content of an existing csv file
+
+    Rows which match a row in the existing file by record ID, event,
+    and repeat instance replace that row; other rows are appended at
+    the end. Returns an iterator over chunks of the merged content,
+    reading the existing file as it is consumed, or None if the
+    headers differ.
+    """
+    delta_rows = _read_csv_rows(
+        StringIO(delta.decode("utf-8", errors="surrogateescape"), newline="")
+    )
+    delta_header, delta_header_raw = next(delta_rows, (None, ""))
+    if delta_header is None:
+        # nothing was exported, nothing to merge
+        delta_header, delta_header_raw = _read_header(filepath)
+    elif _read_header(filepath)[0] != delta_header:
+        return None
+
+    key_idx = _key_columns(delta_header)
+    updates: Dict[Tuple[str, ...], str] = {
+        tuple(row[i] for i in key_idx): raw for row, raw in delta_rows
+    }
+    return _iter_merged(filepath, delta_header_raw, key_idx, updates)
+
+
+def _read_header(filepath: Path) -> Tuple[Optional[List[str]], str]:
+    """Return the header of a csv file, parsed and raw"""
+    with open(filepath, "rt", **CSV_OPEN_KWARGS) as f:
+        return next(_read_csv_rows(f), (None, ""))
+
+
+def _iter_merged(
+    filepath: Path,
+    header_raw: str,
+    key_idx: List[int],
+    updates: Dict[Tuple[str, ...], str],
+) -> Iterator[bytes]:
+    """Yield rows of a csv file, replaced or followed by updated rows"""
+    with open(filepath, "rt", **CSV_OPEN_KWARGS) as f:
+        existing_rows = _read_csv_rows(f)
+        next(existing_rows, None)
+        yield header_raw.encode("utf-8", errors="surrogateescape")
+        for row, raw in existing_rows:
+            raw = updates.pop(tuple(row[i] for i in key_idx), raw)
+            yield raw.encode("utf-8", errors="surrogateescape")
+    for raw in updates.values():
+        yield raw.encode("utf-8", errors="surrogateescape")
@@ -1,8 +1,10 @@
 from pathlib import Path
-from typing import Optional
-
-from redcap.methods.project_info import ProjectInfo
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+)
 
+from datalad.distribution.dataset import Dataset
 from datalad.interface.common_opts import (
     nosave_opt,
     save_message_opt,
@@ -28,48 +30,26 @@ from datalad_next.constraints.dataset import (
 )
 from datalad_next.utils import CredentialManager
 
+from .plan import (
+    format_plan,
+    get_metadata,
+    plan_project_xml_export,
+)
+from .metrics import (
+    export_labels,
+    recorded_export,
+    write_export_metrics,
+)
+from .stats import CommandStats
 from .utils import (
     update_credentials,
     check_ok_to_edit,
+    write_if_changed,
+    obtain_credential,
 )
 
-
-def export_project_xml(
-    self,
-    metadata_only: bool = False,
-    files: bool = False,
-    survey_fields: bool = False,
-    dags: bool = False,
-):
-    """Export Project XML
-
-    This function is a patch for PyCap ProjectInfo class
-    """
-
-    format_type = "xml"
-    payload = self._initialize_payload(
-        content="project_xml",
-        format_type=format_type,
-    )
-
-    payload["returnMetadataOnly"] = metadata_only
-    payload["exportFiles"] = files
-    payload["exportSurveyFields"] = survey_fields
-    payload["exportDataAccessGroups"] = dags
-
-    return_type = self._lookup_return_type(format_type, request_type="export")
-    response = self._call_api(payload, return_type)
-
-    return self._return_data(
-        response=response,
-        content="instrument",
-        format_type=format_type,
-        df_kwargs=None,
-    )
-
-
-# monkey-patch ProjectInfo
-ProjectInfo.export_project_xml = export_project_xml
+if TYPE_CHECKING:
+    from .client import MyProjectInfo
 
 
 @build_doc
@@ -130,6 +110,24 @@ class ExportProjectXML(ValidatedInterface):
             action="store_false",
             doc="do not include survey identifier or survey timestamp fields.",
         ),
+        dry_run=Parameter(
+            args=("--dry-run",),
+            action="store_true",
+            doc="""only estimate the size of the export (number of rows and
+            columns, bytes, and requests), using the list of record IDs and
+            the project metadata. Nothing is written to the dataset.""",
+        ),
+        metrics_file=Parameter(
+            args=("--metrics-file",),
+            metavar="PATH",
+            doc="""write metrics of the export (duration, bytes and rows
+            received, retries, and success) to this file, in the
+            OpenMetrics text format, labelled with the API URL, export type,
+            and output file. Meant for monitoring scheduled exports, e.g.
+            with the textfile collector of Prometheus' node_exporter. The
+            file is replaced after every export, also if it failed. Not
+            written with --dry-run.""",
+        ),
         message=save_message_opt,
         save=nosave_opt,
     )
@@ -142,6 +140,8 @@ class ExportProjectXML(ValidatedInterface):
             credential=EnsureStr(),
             metadata_only=EnsureBool(),
             survey_fields=EnsureBool(),
+            dry_run=EnsureBool(),
+            metrics_file=EnsurePath(),
             message=EnsureStr(),
             save=EnsureBool(),
         ),
@@ -159,15 +159,24 @@ class ExportProjectXML(ValidatedInterface):
         credential: Optional[str] = None,
         metadata_only: bool = False,
         survey_fields: bool = True,
+        dry_run: bool = False,
+        metrics_file: Optional[Path] = None,
         message: Optional[str] = None,
         save: bool = True,
     ):
 
         ds = dataset.ds
+        stats = CommandStats()
+        labels = export_labels(url, "project_xml", None, outfile, ds)
+        # a dry run is not an export worth recording
+        if dry_run:
+            metrics_file = None
 
         # refuse to operate if target file is outside the dataset or not clean
-        ok_to_edit, unlock = check_ok_to_edit(outfile, ds)
+        with stats.phase("status"):
+            ok_to_edit, _ = check_ok_to_edit(outfile, ds)
         if not ok_to_edit:
+            write_export_metrics(metrics_file, labels, stats, 0, False)
             yield get_status_dict(
                 action="export_redcap_report",
                 path=outfile,
@@ -179,58 +188,110 @@ class ExportProjectXML(ValidatedInterface):
             )
             return
 
-        # determine a token
-        credman = CredentialManager(ds.config)
-        credname, credprops = credman.obtain(
-            name=credential,
-            prompt="A token is required to access the REDCap project API",
-            type_hint="token",
-            query_props={"realm": url},
-            expected_props=("secret",),
-        )
-
-        # create an api object
-        api = ProjectInfo(
-            url=url,
-            token=credprops["secret"],
-        )
+        with recorded_export(metrics_file, labels, stats) as record:
+            # determine a token
+            credman = CredentialManager(ds.config)
+            with stats.phase("credentials"):
+                credname, credprops = obtain_credential(credman, url, credential, ds=ds)
 
-        # perform the api query
-        # note: not exporting files or data access groups
-        response = api.export_project_xml(
-            metadata_only=metadata_only,
-            survey_fields=survey_fields,
-        )
+            from .client import (
+                MyProjectInfo,
+                MyRecords,
+            )
 
-        # query went well, store or update credentials
-        update_credentials(credman, credname, credprops)
+            if dry_run:
+                with stats.phase("request"):
+                    plan = plan_project_xml_export(
+                        MyRecords(url=url, token=credprops["secret"], dataset=ds),
+                        get_metadata(url, credprops["secret"], dataset=ds),
+                        metadata_only=metadata_only,
+                        survey_fields=survey_fields,
+                    )
+            else:
+                # create an api object
+                api = record.api = MyProjectInfo(
+                    url=url,
+                    token=credprops["secret"],
+                    dataset=ds,
+                )
 
-        # unlock the file if needed, and write contents
-        if unlock:
-            yield from ds.unlock(
-                outfile, result_renderer="disabled", return_type="generator"
-            )
-        with open(outfile, "wt") as f:
-            f.write(response)
-
-        # save changes in the dataset
-        if save:
-            ds.save(
-                message=message
-                if message is not None
-                else _write_commit_message(
-                    "Export REDCap Project XML",
+                # perform the api query and write contents, unless unchanged
+                changed = write_project_xml(
+                    api,
+                    ds,
+                    outfile,
                     metadata_only=metadata_only,
                     survey_fields=survey_fields,
-                ),
+                    stats=stats,
+                )
+
+            # query went well, store or update credentials
+            update_credentials(credman, credname, credprops)
+
+            # save changes in the dataset
+            if not dry_run and changed and save:
+                with stats.phase("save"):
+                    ds.save(
+                        message=message
+                        if message is not None
+                        else _write_commit_message(
+                            "Export REDCap Project XML",
+                            metadata_only=metadata_only,
+                            survey_fields=survey_fields,
+                        ),
+                        path=outfile,
+                    )
+
+        if dry_run:
+            yield get_status_dict(
+                action="export_redcap_project_xml",
                 path=outfile,
+                status="ok",
+                message=format_plan(plan),
+                plan=plan,
+                **stats.result_props(),
             )
+            return
 
         # yield successful result if we made it to here
         yield get_status_dict(
             action="export_redcap_project_xml",
             path=outfile,
-            status="ok",
+            status="ok" if changed else "notneeded",
+            message=None if changed else "exported content did not change",
+            retries=api.retries,
+            retry_wait=api.retry_wait,
+            **stats.result_props(),
+        )
+
+
+def write_project_xml(
+    api: "MyProjectInfo",
+    ds: Dataset,
+    outfile: Path,
+    metadata_only: bool = False,
+    survey_fields: bool = True,
+    stats: Optional[CommandStats] = None,
+) -> bool:
+    """Export project XML into a file, unless unchanged
+
+    Performs the API request, and writes the output file with
+    write_if_changed, without saving. If given, ``stats`` records the
+    request, download and write phases, and the bytes received.
+    Returns True if the file was written.
+    """
+    if stats is None:
+        stats = CommandStats()
+    # outputs an iterator over chunks of the response
+    # note: not exporting files or data access groups
+    with stats.phase("request"):
+        response = api.export_project_xml(
+            metadata_only=metadata_only,
+            survey_fields=survey_fields,
+        )
+    with stats.phase("write"):
+        return write_if_changed(
+            stats.count(response), outfile, ds, label="Downloading project XML"
         )
 
 
@@ -1,8 +1,10 @@
 from pathlib import Path
-from typing import Optional
-
-from redcap.methods.reports import Reports
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+)
 
+from datalad.distribution.dataset import Dataset
 from datalad.interface.common_opts import (
     nosave_opt,
     save_message_opt,
@@ -29,11 +31,22 @@ from datalad_next.constraints.dataset import (
 )
 from datalad_next.utils import CredentialManager
 
+from .metrics import (
+    export_labels,
+    recorded_export,
+    write_export_metrics,
+)
+from .stats import CommandStats
 from .utils import (
     update_credentials,
     check_ok_to_edit,
+    write_if_changed,
+    obtain_credential,
 )
 
+if TYPE_CHECKING:
+    from .client import MyReports
+
 
 @build_doc
 class ExportReport(ValidatedInterface):
@@ -79,6 +92,16 @@ class ExportReport(ValidatedInterface):
             present; otherwise the user will be prompted and the
             credential will be saved under a default name.""",
         ),
+        metrics_file=Parameter(
+            args=("--metrics-file",),
+            metavar="PATH",
+            doc="""write metrics of the export (duration, bytes and rows
+            received, retries, and success) to this file, in the
+            OpenMetrics text format, labelled with the API URL, report ID,
+            and output file. Meant for monitoring scheduled exports, e.g.
+            with the textfile collector of Prometheus' node_exporter. The
+            file is replaced after every export, also if it failed.""",
+        ),
         message=save_message_opt,
         save=nosave_opt,
     )
@@ -90,6 +113,7 @@ class ExportReport(ValidatedInterface):
             outfile=EnsurePath(),
             dataset=EnsureDataset(installed=True, purpose="export REDCap report"),
             credential=EnsureStr(),
+            metrics_file=EnsurePath(),
             message=EnsureStr(),
             save=EnsureBool(),
         ),
@@ -106,15 +130,20 @@ class ExportReport(ValidatedInterface):
         outfile: Path,
         dataset: Optional[DatasetParameter] = None,
         credential: Optional[str] = None,
+        metrics_file: Optional[Path] = None,
         message: Optional[str] = None,
         save: bool = True,
     ):
 
         ds = dataset.ds
+        stats = CommandStats()
+        labels = export_labels(url, "report", report, outfile, ds)
 
         # refuse to operate if target file is outside the dataset or not clean
-        ok_to_edit, unlock = check_ok_to_edit(outfile, ds)
+        with stats.phase("status"):
+            ok_to_edit, _ = check_ok_to_edit(outfile, ds)
         if not ok_to_edit:
+            write_export_metrics(metrics_file, labels, stats, 0, False)
             yield get_status_dict(
                 action="export_redcap_report",
                 path=outfile,
@@ -126,49 +155,75 @@ class ExportReport(ValidatedInterface):
             )
             return
 
-        # determine a token
-        credman = CredentialManager(ds.config)
-        credname, credprops = credman.obtain(
-            name=credential,
-            prompt="A token is required to access the REDCap project API",
-            type_hint="token",
-            query_props={"realm": url},
-            expected_props=("secret",),
-        )
+        with recorded_export(metrics_file, labels, stats) as record:
+            # determine a token
+            credman = CredentialManager(ds.config)
+            with stats.phase("credentials"):
+                credname, credprops = obtain_credential(credman, url, credential, ds=ds)
 
-        # create an api object
-        api = Reports(
-            url=url,
-            token=credprops["secret"],
-        )
+            # create an api object
+            from .client import MyReports
 
-        # perform the api query
-        response = api.export_report(
-            report_id=report,
-            format_type="csv",
-        )
+            api = record.api = MyReports(
+                url=url,
+                token=credprops["secret"],
+                dataset=ds,
+            )
 
-        # query went well, store or update credentials
-        update_credentials(credman, credname, credprops)
+            # perform the api query and write contents, unless unchanged
+            changed = write_report(api, ds, outfile, report, stats=stats)
 
-        # unlock the file if needed, and write contents
-        if unlock:
-            yield from ds.unlock(
-                outfile, result_renderer="disabled", return_type="generator"
-            )
-        with open(outfile, "wt") as f:
-            f.write(response)
+            # query went well, store or update credentials
+            update_credentials(credman, credname, credprops)
 
-        # save changes in the dataset
-        if save:
-            ds.save(
-                message=message if message is not None else "Export REDCap report",
-                path=outfile,
-            )
+            # save changes in the dataset
+            if changed and save:
+                with stats.phase("save"):
+                    ds.save(
+                        message=message
+                        if message is not None
+                        else "Export REDCap report",
+                        path=outfile,
+                    )
 
         # yield successful result if we made it to here
         yield get_status_dict(
             action="export_redcap_report",
             path=outfile,
-            status="ok",
+            status="ok" if changed else "notneeded",
+            message=None if changed else "exported content did not change",
+            retries=api.retries,
+            retry_wait=api.retry_wait,
+            **stats.result_props(),
+        )
+
+
+def write_report(
+    api: "MyReports",
+    ds: Dataset,
+    outfile: Path,
+    report: str,
+    stats: Optional[CommandStats] = None,
+) -> bool:
+    """Export a report into a csv file, unless unchanged
+
+    Performs the API request, and writes the output file with
+    write_if_changed, without saving. If given, ``stats`` records the
+    request, download and write phases, and the bytes and rows
+    received. Returns True if the file was written.
+    """
+    if stats is None:
+        stats = CommandStats()
+    # outputs an iterator over chunks of the response
+    with stats.phase("request"):
+        response = api.export_report(
+            report_id=report,
+            format_type="csv",
+        )
+    with stats.phase("write"):
+        return write_if_changed(
+            stats.count(response, csv=True),
+            outfile,
+            ds,
+            label="Downloading report",
         )
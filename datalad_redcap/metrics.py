@@ -0,0 +1,151 @@
+"""Metrics of exports, written as OpenMetrics text files
+
+The files are meant to be picked up by monitoring systems, e.g. the
+textfile collector of Prometheus' node_exporter.
+"""
+
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import time
+from types import SimpleNamespace
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from uuid import uuid4
+
+from datalad.distribution.dataset import Dataset
+
+from .stats import CommandStats
+
+# prefix of all metric names
+PREFIX = "datalad_redcap_export_"
+
+# metrics written for every export: name (without prefix), type, unit,
+# and help text
+METRICS = (
+    ("duration_seconds", "gauge", "seconds", "Time spent on the export"),
+    ("bytes", "gauge", "bytes", "Bytes received from the server"),
+    ("rows", "gauge", None, "Csv rows received from the server"),
+    ("retries", "gauge", None, "Requests retried after transient failures"),
+    ("success", "gauge", None, "Whether the export succeeded (1) or failed (0)"),
+    ("timestamp_seconds", "gauge", "seconds", "When the export finished"),
+)
+
+
+def export_labels(
+    url: str,
+    export_type: str,
+    name: Optional[str],
+    outfile: Optional[Path],
+    ds: Dataset,
+) -> Dict[str, str]:
+    """Return the labels identifying an export
+
+    ``name`` is the form name(s) or report ID, if any. The output file
+    (if known) is given relative to the dataset.
+    """
+    labels = dict(url=url, type=export_type)
+    if name is not None:
+        labels["name"] = name
+    if outfile is not None:
+        labels["path"] = Path(os.path.relpath(outfile, ds.pathobj)).as_posix()
+    return labels
+
+
+def export_values(
+    stats: CommandStats, retries: int, success: bool
+) -> Dict[str, Optional[float]]:
+    """Return the values of all metrics of an export
+
+    The duration is the sum of the timed phases. Values which are not
+    known (e.g. rows of an xml export) are None.
+    """
+    return dict(
+        duration_seconds=sum(stats.timings.values()),
+        bytes=stats.bytes,
+        rows=stats.rows,
+        retries=retries,
+        success=int(success),
+        timestamp_seconds=time.time(),
+    )
+
+
+@contextmanager
+def recorded_export(path: Optional[Path], labels: Dict[str, str], stats: CommandStats):
+    """Write metrics of the export performed in the context
+
+    Metrics are written to the given file when the context exits, also
+    if the export failed with an exception. Nothing is written if the
+    path is None. The context value has an ``api`` attribute, to be set
+    to the API object used for the export once it is created (for the
+    number of retries).
+    """
+    record = SimpleNamespace(api=None)
+    success = False
+    try:
+        yield record
+        success = True
+    finally:
+        retries = record.api.retries if record.api is not None else 0
+        write_export_metrics(path, labels, stats, retries, success)
+
+
+def write_export_metrics(
+    path: Optional[Path],
+    labels: Dict[str, str],
+    stats: CommandStats,
+    retries: int,
+    success: bool,
+):
+    """Write metrics of a single export, unless the path is None"""
+    if path is not None:
+        write_metrics(path, [(labels, export_values(stats, retries, success))])
+
+
+def write_metrics(
+    path: Path, exports: Iterable[Tuple[Dict[str, str], Dict[str, Optional[float]]]]
+):
+    """Write metrics of exports, given as labels and values, to a file
+
+    The file is replaced in a single step, so that a collector never
+    reads a partial file.
+    """
+    exports = list(exports)
+    lines: List[str] = []
+    for name, metric_type, unit, help_text in METRICS:
+        samples = [(labels, v[name]) for labels, v in exports if v[name] is not None]
+        if not samples:
+            continue
+        metric = PREFIX + name
+        lines.append(f"# TYPE {metric} {metric_type}")
+        if unit is not None:
+            lines.append(f"# UNIT {metric} {unit}")
+        lines.append(f"# HELP {metric} {help_text}")
+        for labels, value in samples:
+            lines.append(f"{metric}{{{_format_labels(labels)}}} {value}")
+    lines.append("# EOF")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmpfile = path.with_name(f".{path.name}.{uuid4().hex[:8]}.part")
+    try:
+        with open(tmpfile, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmpfile, path)
+    except BaseException:
+        tmpfile.unlink(missing_ok=True)
+        raise
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """Format labels of a sample, escaping their values"""
+    return ",".join(
+        '{}="{}"'.format(
+            k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in labels.items()
+    )
@@ -0,0 +1,138 @@
+"""Estimate the size of exports, without performing them"""
+
+from math import ceil
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+from datalad.distribution.dataset import Dataset
+from datalad.utils import bytes2human
+
+from .cache import cached
+from .query import build_field_index
+
+if TYPE_CHECKING:
+    from .client import MyRecords
+
+# rough size of a single value in a csv export, and in a project xml
+# export (which repeats the field name in an ItemData element for
+# every value)
+CSV_VALUE_BYTES = 8
+XML_VALUE_BYTES = 48
+
+# size of an export above which batches are recommended, and which
+# recommended batches should not exceed
+TARGET_REQUEST_BYTES = 32 * 1024 * 1024
+
+
+def get_metadata(url: str, token: str, dataset: Optional[Dataset] = None) -> List[dict]:
+    """Return the project metadata (data dictionary), using the cache"""
+    from .client import MyMetadata
+
+    api = MyMetadata(url=url, token=token, dataset=dataset)
+    return cached("metadata", url, token, api.export_metadata)
+
+
+def count_columns(
+    metadata: Iterable[dict], forms: Optional[List[str]], survey_fields: bool
+) -> int:
+    """Return the number of csv columns in an export of the given forms
+
+    Checkbox fields have one column per choice, descriptive fields have
+    none, and every form adds a form status column (and, with survey
+    fields, up to two survey columns). The record ID column is always
+    included. ``forms=None`` stands for all forms.
+    """
+    index = build_field_index(metadata)
+    if forms is None:
+        forms = list(dict.fromkeys(f["form_name"] for f in index.values()))
+    columns = len(forms) * (3 if survey_fields else 1)
+    record_id = next(iter(index), None)
+    if record_id is not None and index[record_id]["form_name"] not in forms:
+        columns += 1
+    for field in index.values():
+        if field["form_name"] not in forms or field["field_type"] == "descriptive":
+            continue
+        if field["field_type"] == "checkbox":
+            columns += len(field["choices"])
+        else:
+            columns += 1
+    return columns
+
+
+def plan_form_export(
+    api: "MyRecords",
+    metadata: List[dict],
+    forms: List[str],
+    survey_fields: bool = True,
+    batch_size: Optional[int] = None,
+) -> Dict[str, Optional[int]]:
+    """Estimate the size of a form export, and recommend a batch size
+
+    Only lists record IDs (one cheap call), and uses the metadata to
+    count columns. The number of rows is an upper bound in longitudinal
+    projects, in which not all forms are used in every event.
+    """
+    rows = api.export_record_id_rows()
+    records = len(set(rows))
+    columns = count_columns(metadata, forms, survey_fields)
+    nbytes = len(rows) * columns * CSV_VALUE_BYTES
+    return dict(
+        records=records,
+        rows=len(rows),
+        columns=columns,
+        bytes=nbytes,
+        requests=1 + ceil(records / batch_size) if batch_size else 1,
+        recommended_batch_size=_recommend_batch_size(records, nbytes),
+    )
+
+
+def plan_project_xml_export(
+    api: "MyRecords",
+    metadata: List[dict],
+    metadata_only: bool = False,
+    survey_fields: bool = True,
+) -> Dict[str, Optional[int]]:
+    """Estimate the size of a project xml export
+
+    The metadata part is estimated from the size of the metadata in
+    json. Project xml can not be exported in batches.
+    """
+    rows = [] if metadata_only else api.export_record_id_rows()
+    columns = count_columns(metadata, None, survey_fields)
+    nbytes = sum(len(str(v)) for f in metadata for v in f.values())
+    nbytes += len(rows) * columns * XML_VALUE_BYTES
+    return dict(
+        records=len(set(rows)),
+        rows=len(rows),
+        columns=columns,
+        bytes=nbytes,
+        requests=1,
+        recommended_batch_size=None,
+    )
+
+
+def format_plan(plan: Dict[str, Optional[int]]) -> str:
+    """Return a one-line summary of an export plan"""
+    summary = (
+        f"would export {plan['rows']} rows ({plan['records']} records) "
+        f"with {plan['columns']} columns, about {bytes2human(plan['bytes'])}, "
+        f"in {plan['requests']} request(s)"
+    )
+    if plan["recommended_batch_size"] is not None:
+        summary += f"; recommended batch size: {plan['recommended_batch_size']}"
+    return summary
+
+
+def _recommend_batch_size(records: int, nbytes: int) -> Optional[int]:
+    """Return a batch size keeping requests below the target size
+
+    Returns None if the entire export is below the target size.
+    """
+    if nbytes <= TARGET_REQUEST_BYTES or records == 0:
+        return None
+    return max(1, int(TARGET_REQUEST_BYTES // (nbytes / records)))
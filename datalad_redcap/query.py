@@ -1,10 +1,13 @@
 """Query REDCap's API for exportable items"""
 
+from fnmatch import fnmatchcase
 import os
-from typing import Optional
-
-from prettytable import PrettyTable
-from redcap.methods.instruments import Instruments
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
 
 from datalad.ui import ui
 from datalad_next.commands import (
@@ -16,42 +19,74 @@ from datalad_next.commands import (
     get_status_dict,
 )
 from datalad_next.constraints import (
+    EnsureBool,
+    EnsureListOf,
     EnsureStr,
     EnsureURL,
 )
+from datalad_next.constraints.dataset import (
+    DatasetParameter,
+    EnsureDataset,
+)
 from datalad_next.utils import CredentialManager
 
-from .utils import update_credentials
+from .cache import cached
+from .stats import CommandStats
+from .utils import (
+    obtain_credential,
+    update_credentials,
+)
+
+
+# field types with choices listed in the data dictionary
+CHOICE_FIELD_TYPES = ("radio", "dropdown", "checkbox")
 
 
-class MyInstruments(Instruments):
-    """An extension of PyCap's Instruments class
+def build_field_index(metadata: Iterable[dict]) -> Dict[str, dict]:
+    """Build an index of fields from the project metadata (json)
 
-    Contains an additional method to export instruments names and labels
+    Maps each field name to a dictionary with the ``field_name``,
+    ``form_name``, ``field_type`` and ``field_label``, and ``choices``
+    (a mapping of coded values to labels, for radio, dropdown and
+    checkbox fields, otherwise None).
     """
+    index = {}
+    for row in metadata:
+        choices = None
+        if row.get("field_type") in CHOICE_FIELD_TYPES:
+            choices = _parse_choices(row.get("select_choices_or_calculations", ""))
+        index[row["field_name"]] = {
+            "field_name": row["field_name"],
+            "form_name": row.get("form_name"),
+            "field_type": row.get("field_type"),
+            "field_label": row.get("field_label"),
+            "choices": choices,
+        }
+    return index
 
-    def export_instruments(self):
-        """Export instruments names and labels
-
-        PyCap's Instruments class has a field_names property, but lacks
-        a method to return matching labels (human-readable). This method
-        does that in a simplified way (only supports json format, does not
-        support arms).
-        """
-        format_type = "json"  # constant, for now
-        payload = self._initialize_payload(
-            content="instrument",
-            format_type=format_type,
-        )
-        return_type = self._lookup_return_type(format_type, request_type="export")
-        response = self._call_api(payload, return_type)
-
-        return self._return_data(
-            response=response,
-            content="instrument",
-            format_type=format_type,
-            df_kwargs=None,
-        )
+
+def find_fields(index: Dict[str, dict], patterns: Iterable[str]) -> List[dict]:
+    """Return index entries of fields matching any of the glob patterns
+
+    Entries are returned in the order of the index (i.e. of the data
+    dictionary).
+    """
+    patterns = list(patterns)
+    return [
+        entry
+        for name, entry in index.items()
+        if any(fnmatchcase(name, pattern) for pattern in patterns)
+    ]
+
+
+def _parse_choices(choices: str) -> Dict[str, str]:
+    """Parse choices in REDCap's "1, Yes | 2, No" format"""
+    parsed = {}
+    for choice in choices.split("|"):
+        value, _, label = choice.partition(",")
+        if value.strip():
+            parsed[value.strip()] = label.strip()
+    return parsed
 
 
 @build_doc
@@ -62,12 +97,28 @@ class Query(ValidatedInterface):
     names of instruments (data entry forms) which can be exported from
     the project.
 
+    With --fields, fields matching the given names or patterns are
+    listed instead, together with the form they belong to, their type,
+    and choices. This is answered from the project metadata (data
+    dictionary), which is requested once and cached.
+
     [PY: Returns a result record dictionary, in which ``instruments``
     is a list of dictionaries, with ``instrument_name`` and
-    ``instrument_label`` keys. PY]
+    ``instrument_label`` keys. With ``fields``, the record instead
+    contains ``fields``, a list of dictionaries with ``field_name``,
+    ``form_name``, ``field_type``, ``field_label`` and ``choices``
+    keys. PY]
 
     [CMD: Displays a table with results. CMD]
 
+    Results are cached on disk (per API URL and token), for the number
+    of seconds given by the ``datalad.redcap.metadata-cache-ttl``
+    configuration (default: 3600, 0 disables the cache).
+
+    Other configuration (e.g. ``datalad.redcap.rate-limit``) is read
+    from the dataset given with --dataset, or only from the global
+    configuration if no dataset is given.
+
     """
 
     result_renderer = "tailored"
@@ -77,6 +128,14 @@ class Query(ValidatedInterface):
             args=("url",),
             doc="API URL to a REDCap server",
         ),
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar="PATH",
+            doc="""the dataset whose configuration is used for the API
+            requests, including their rate limit, which is then shared
+            with commands working on the same dataset. If no dataset is
+            given, only the global configuration is used.""",
+        ),
         credential=Parameter(
             args=("--credential",),
             metavar="name",
@@ -88,41 +147,90 @@ class Query(ValidatedInterface):
             present; otherwise the user will be prompted and the
             credential will be saved under a default name.""",
         ),
+        fields=Parameter(
+            args=("--fields",),
+            nargs="+",
+            metavar="PATTERN",
+            doc="""list fields with the given names, or matching the given
+            glob patterns (e.g. "bmi_*"), instead of instruments.""",
+        ),
+        refresh=Parameter(
+            args=("--refresh",),
+            action="store_true",
+            doc="""query the server even if cached results are
+            available, and update the cache.""",
+        ),
     )
 
     _validator_ = EnsureCommandParameterization(
         dict(
             url=EnsureURL(required=["scheme", "netloc", "path"]),
+            dataset=EnsureDataset(installed=True, purpose="query REDCap"),
             credential=EnsureStr(),
+            fields=EnsureListOf(str),
+            refresh=EnsureBool(),
         ),
     )
 
     @staticmethod
     @eval_results
-    def __call__(url: str, credential: Optional[str] = None):
+    def __call__(
+        url: str,
+        dataset: Optional[DatasetParameter] = None,
+        credential: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        refresh: bool = False,
+    ):
+
+        ds = dataset.ds if dataset is not None else None
+        stats = CommandStats()
 
         # determine the token
-        credman = CredentialManager()
-        credname, credprops = credman.obtain(
-            name=credential,
-            prompt="A token is required to access the REDCap project API",
-            type_hint="token",
-            query_props={"realm": url},
-            expected_props=("secret",),
+        credman = CredentialManager(ds.config if ds is not None else None)
+        with stats.phase("credentials"):
+            credname, credprops = obtain_credential(credman, url, credential, ds=ds)
+
+        # perform api query, unless cached
+        from .client import (
+            MyInstruments,
+            MyMetadata,
         )
 
-        # perform api query
-        api = MyInstruments(url=url, token=credprops["secret"])
-        instruments = api.export_instruments()
+        if fields is not None:
+            api = MyMetadata(url=url, token=credprops["secret"], dataset=ds)
+            with stats.phase("request"):
+                metadata = cached(
+                    "metadata",
+                    url,
+                    credprops["secret"],
+                    api.export_metadata,
+                    refresh=refresh,
+                )
+            items = {"fields": find_fields(build_field_index(metadata), fields)}
+        else:
+            api = MyInstruments(url=url, token=credprops["secret"], dataset=ds)
+            with stats.phase("request"):
+                instruments = cached(
+                    "instruments",
+                    url,
+                    credprops["secret"],
+                    api.export_instruments,
+                    refresh=refresh,
+                )
+            items = {"instruments": instruments}
+        stats.rows = len(next(iter(items.values())))
 
         # query went well, store or update credentials
         update_credentials(credman, credname, credprops)
 
         yield get_status_dict(
             action="redcap_query",
-            path=os.getcwd(),
+            path=ds.path if ds is not None else os.getcwd(),
             status="ok",
-            instruments=instruments,
+            retries=api.retries,
+            retry_wait=api.retry_wait,
+            **stats.result_props(),
+            **items,
         )
 
     @staticmethod
@@ -132,9 +240,18 @@ class Query(ValidatedInterface):
         if res["status"] != "ok" or res.get("action", "") != "redcap_query":
             return
 
+        from prettytable import PrettyTable
+
         tbl = PrettyTable()
-        tbl.field_names = ["Instrument label", "Instrument name"]
         tbl.align = "l"
-        for x in res.get("instruments", []):
-            tbl.add_row([x["instrument_label"], x["instrument_name"]])
+        if "fields" in res:
+            tbl.field_names = ["Field name", "Form name", "Type", "Field label"]
+            for x in res["fields"]:
+                tbl.add_row(
+                    [x["field_name"], x["form_name"], x["field_type"], x["field_label"]]
+                )
+        else:
+            tbl.field_names = ["Instrument label", "Instrument name"]
+            for x in res.get("instruments", []):
+                tbl.add_row([x["instrument_label"], x["instrument_name"]])
         ui.message(tbl.get_string())
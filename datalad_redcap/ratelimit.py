@@ -0,0 +1,123 @@
+"""Rate limiting of API requests, shared across processes"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock
+import time
+from typing import (
+    Dict,
+    Optional,
+)
+from urllib.parse import urlparse
+
+import fasteners
+
+import datalad
+from datalad.distribution.dataset import Dataset
+
+from .cache import get_cache_dir
+
+lgr = logging.getLogger("datalad.redcap.ratelimit")
+
+# configuration item with the allowed number of requests per minute
+RATE_VAR = "datalad.redcap.rate-limit"
+
+# locks for threads of this process (the lock file only works between
+# processes), per state file
+_thread_locks: Dict[Path, Lock] = {}
+_thread_locks_lock = Lock()
+
+
+class RateLimiter:
+    """A token bucket, limiting the rate of requests to an API
+
+    Allows bursts of up to ``rate`` requests (at least one), and refills
+    at ``rate`` requests per minute. The bucket is identified by the API host and
+    token, and its state is kept in a JSON file, guarded by a lock
+    file, so that it is shared by all processes (and threads) which
+    use the same state file.
+    """
+
+    def __init__(self, url: str, token: str, rate: float, state_file: Path):
+        self.rate = rate
+        self.state_file = state_file
+        self.key = hashlib.sha256(
+            f"{urlparse(url).netloc}\0{token}".encode()
+        ).hexdigest()
+        with _thread_locks_lock:
+            self._thread_lock = _thread_locks.setdefault(state_file, Lock())
+
+    def acquire(self) -> float:
+        """Take a token from the bucket, waiting for one if necessary
+
+        Returns the time spent waiting, in seconds.
+        """
+        waited = 0.0
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return waited
+            lgr.debug("Rate limit reached, waiting %.2f s", wait)
+            time.sleep(wait)
+            waited += wait
+
+    def _take(self) -> float:
+        """Take a token if available, or return the time to wait for one"""
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = self.state_file.with_name(self.state_file.name + ".lck")
+        with self._thread_lock, fasteners.InterProcessLock(str(lock_file)):
+            state = self._read_state()
+            now = time.time()
+            # with less than one request per minute, the bucket still
+            # has to hold a whole token
+            capacity = max(1.0, self.rate)
+            bucket = state.get(self.key, {"tokens": capacity, "time": now})
+            elapsed = max(0.0, now - bucket["time"])
+            tokens = min(capacity, bucket["tokens"] + elapsed * self.rate / 60)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) * 60 / self.rate
+            state[self.key] = {"tokens": tokens, "time": now}
+            self._write_state(state)
+        return wait
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state: dict):
+        tmpfile = self.state_file.with_name(self.state_file.name + ".part")
+        with open(tmpfile, "w") as f:
+            json.dump(state, f)
+        os.replace(tmpfile, self.state_file)
+
+
+def get_rate_limiter(
+    url: str, token: str, ds: Optional[Dataset] = None
+) -> Optional[RateLimiter]:
+    """Return a rate limiter for the API, or None if no limit is configured
+
+    The rate (requests per minute) is read from the
+    ``datalad.redcap.rate-limit`` configuration of the given dataset,
+    or only from the global configuration if no dataset is given (e.g.
+    for ``redcap-query`` without ``--dataset``). The state is kept in
+    the ``.git`` directory of the dataset, or in DataLad's cache
+    location if no dataset is given.
+    """
+    cfg = ds.config if ds is not None else datalad.cfg
+    rate = cfg.get(RATE_VAR)
+    if not rate or float(rate) <= 0:
+        return None
+    if ds is not None:
+        state_file = ds.repo.dot_git / "datalad" / "redcap-ratelimit.json"
+    else:
+        state_file = get_cache_dir() / "ratelimit.json"
+    return RateLimiter(url, token, float(rate), state_file)
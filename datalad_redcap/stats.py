@@ -0,0 +1,117 @@
+"""Timings and transfer sizes of commands, for their result records"""
+
+from contextlib import contextmanager
+import time
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+
+
+class CommandStats:
+    """Time the phases of a command, and count the data it received
+
+    Phases (e.g. ``credentials``, ``request``, ``write``, ``save``) are
+    timed with ``phase``, used as a context manager. Phases can be
+    nested, and the time spent in an inner phase is only counted
+    toward the inner one. Responses passed through ``count`` are
+    counted in bytes and, for csv, in rows (without the header), and
+    the time spent waiting for their chunks is counted as the
+    ``download`` phase. ``result_props`` returns the numbers, to be
+    included in a result record.
+
+    Durations are in seconds, and accumulate if a phase is entered
+    more than once. An object is meant to be used by one thread.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.bytes: Optional[int] = None
+        self.rows: Optional[int] = None
+        self._active: List[str] = []
+        self._since = 0.0
+
+    @contextmanager
+    def phase(self, name: str):
+        """Count the time spent in the context toward a phase"""
+        now = time.perf_counter()
+        if self._active:
+            self._add(self._active[-1], now - self._since)
+        self._active.append(name)
+        self._since = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add(self._active.pop(), now - self._since)
+            self._since = now
+
+    def count(self, chunks: Iterable[bytes], csv: bool = False) -> Iterator[bytes]:
+        """Pass on chunks of a response, counting and timing them"""
+        self.bytes = self.bytes or 0
+        counter = CsvRowCounter() if csv else None
+        chunks = iter(chunks)
+        try:
+            while True:
+                with self.phase("download"):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                self.bytes += len(chunk)
+                if counter is not None:
+                    counter.update(chunk)
+                yield chunk
+        finally:
+            if counter is not None:
+                self.rows = (self.rows or 0) + counter.rows
+
+    def result_props(self) -> Dict[str, Any]:
+        """Return timings, bytes and rows, as result record properties"""
+        props = dict(timings=dict(self.timings))
+        if self.bytes is not None:
+            props["bytes"] = self.bytes
+        if self.rows is not None:
+            props["rows"] = self.rows
+        return props
+
+    def _add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+class CsvRowCounter:
+    """Count the rows of csv content, as it arrives in chunks
+
+    A line break ends a row unless it is part of a quoted value, i.e.
+    unless an odd number of quote characters precedes it (escaped
+    quotes come in pairs). The header row is not counted.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self._quoted = False
+        self._partial = False
+
+    def update(self, chunk: bytes):
+        if not chunk:
+            return
+        if not self._quoted and b'"' not in chunk:
+            self.lines += chunk.count(b"\n")
+        else:
+            *complete, rest = chunk.split(b"\n")
+            for piece in complete:
+                if piece.count(b'"') % 2:
+                    self._quoted = not self._quoted
+                if not self._quoted:
+                    self.lines += 1
+            if rest.count(b'"') % 2:
+                self._quoted = not self._quoted
+        self._partial = not chunk.endswith(b"\n")
+
+    @property
+    def rows(self) -> int:
+        # the last row may lack a line break
+        return max(0, self.lines + self._partial - 1)
@@ -0,0 +1,94 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from redcap.request import RedcapError
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from datalad_redcap.aio import AsyncProject  # noqa: E402
+
+TOKEN = "WTJ3G8XWO9G8V1BB4K8N81KNGRPFJOVL"
+METADATA = [{"field_name": "record_id", "form_name": "foo"}]
+
+
+async def _run_with_server(handler, test):
+    """Run a coroutine function with the URL of a local API server"""
+    app = web.Application()
+    app.router.add_post("/api/", handler)
+    async with TestServer(app) as server:
+        return await test(str(server.make_url("/api/")))
+
+
+def test_async_project_exports():
+    requests = []
+
+    async def handler(request):
+        data = await request.post()
+        requests.append(dict(data))
+        if data["content"] == "metadata":
+            return web.json_response(METADATA)
+        if len(requests) == 2:
+            # a transient failure
+            return web.Response(status=503, text="Service unavailable")
+        records = [v for k, v in data.items() if k.startswith("records[")]
+        rows = "".join(f"{r},spam\n" for r in records)
+        return web.Response(text=f"record_id,foo\n{rows}")
+
+    async def test(url):
+        async with AsyncProject(url, TOKEN) as project:
+            project.retry_delay = 0.01
+            # export_records needs the record ID field name, which
+            # is looked up in the metadata first
+            first = await project.export_records(
+                format_type="csv", records=["1"], fields=["foo"]
+            )
+            # calls run at the same time, and reuse the metadata
+            rest = await asyncio.gather(
+                *(
+                    project.export_records(
+                        format_type="csv", records=[str(i)], fields=["foo"]
+                    )
+                    for i in range(2, 6)
+                )
+            )
+            return [first, *rest], project.retries
+
+    results, retries = asyncio.run(_run_with_server(handler, test))
+    assert results == [f"record_id,foo\n{i},spam\n" for i in range(1, 6)]
+    assert retries == 1
+    assert [r["content"] for r in requests].count("metadata") == 1
+    assert requests[1]["fields[1]"] == "record_id"
+
+
+def test_async_project_errors():
+    async def handler(request):
+        return web.json_response({"error": "You do not have permissions"})
+
+    async def test(url):
+        async with AsyncProject(url, TOKEN) as project:
+            with pytest.raises(RedcapError):
+                await project.export_metadata()
+            with pytest.raises(AttributeError):
+                project.metadata
+            # uploads are not supported
+            assert not hasattr(project, "import_file")
+
+    asyncio.run(_run_with_server(handler, test))
+
+
+def test_async_project_rate_limit():
+    async def handler(request):
+        return web.json_response(METADATA)
+
+    async def test(url):
+        # the limiter blocks, it is run in a thread
+        with patch("datalad_redcap.aio.get_rate_limiter") as get_rate_limiter:
+            async with AsyncProject(url, TOKEN) as project:
+                await project.export_metadata()
+        return get_rate_limiter.return_value.acquire.call_count
+
+    assert asyncio.run(_run_with_server(handler, test)) == 1
@@ -0,0 +1,199 @@
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import pytest
+import requests
+
+from redcap.request import RedcapError
+
+from datalad_redcap.client import (
+    MyRecords,
+    RedcapServerError,
+)
+
+TOKEN = "WTJ3G8XWO9G8V1BB4K8N81KNGRPFJOVL"
+
+
+def _fake_response(chunks, status_code=200):
+    """Return a mock of a streamed requests.Response"""
+    response = MagicMock()
+    response.ok = status_code < 400
+    response.status_code = status_code
+    response.text = b"".join(chunks).decode()
+    response.iter_content.return_value = iter(chunks)
+    return response
+
+
+@pytest.fixture
+def records_api(api_url):
+    """Yield a MyRecords object which does not need to query metadata"""
+    api = MyRecords(url=api_url, token=TOKEN)
+    api._def_field = "record_id"
+    yield api
+
+
+def test_csv_export_is_streamed(records_api):
+    chunks = [b"record_id,foo\n", b"1,spam\n", b"2,ham\n"]
+    response = _fake_response(chunks)
+    api = records_api
+
+    with patch("requests.Session.post", return_value=response) as post:
+        result = api.export_records(format_type="csv", fields=["record_id", "foo"])
+        # the request is made, but content is not consumed until iterated over
+        assert post.call_args.kwargs["stream"]
+        response.close.assert_not_called()
+        assert list(result) == chunks
+    response.close.assert_called()
+
+
+def test_stream_errors_are_raised(records_api):
+    api = records_api
+
+    # error status
+    response = _fake_response([b"ERROR: You do not have permissions"], 403)
+    with patch("requests.Session.post", return_value=response):
+        with pytest.raises(RedcapError):
+            api.export_records(format_type="csv", fields=["record_id"])
+
+    # error message in place of content
+    response = _fake_response([b"ERROR: The value of the parameter is invalid"])
+    with patch("requests.Session.post", return_value=response):
+        with pytest.raises(RedcapError):
+            api.export_records(format_type="csv", fields=["record_id"])
+
+
+def test_project_xml_is_streamed(api_url):
+    from datalad_redcap.client import MyProjectInfo
+
+    chunks = [b'<?xml version="1.0" encoding="UTF-8" ?>', b"<ODM></ODM>"]
+    response = _fake_response(chunks)
+    api = MyProjectInfo(url=api_url, token=TOKEN)
+
+    with patch("requests.Session.post", return_value=response) as post:
+        result = api.export_project_xml(metadata_only=True)
+        assert post.call_args.kwargs["data"]["content"] == "project_xml"
+        assert list(result) == chunks
+
+
+def test_drop_first_line():
+    from datalad_redcap.client import _drop_first_line
+
+    # header split across chunks
+    chunks = [b"record_", b"id,foo\n1,", b"spam\n"]
+    assert b"".join(_drop_first_line(chunks)) == b"1,spam\n"
+    # header only
+    assert b"".join(_drop_first_line([b"record_id,foo\n"])) == b""
+
+
+def test_session_is_shared(api_url):
+    from datalad_redcap.client import MyReports
+
+    records_api = MyRecords(url=api_url, token=TOKEN)
+    reports_api = MyReports(url=api_url, token=TOKEN)
+    other_api = MyRecords(url="https://example.org/api/", token=TOKEN)
+    records_api._def_field = other_api._def_field = "record_id"
+    with patch.object(requests.Session, "post", autospec=True) as post:
+        post.return_value.ok = True
+        post.return_value.content = b'[{"record_id": "1"}]'
+        for api in (records_api, other_api):
+            api.export_records(format_type="json", fields=["record_id"])
+        reports_api.export_report(report_id="1", format_type="json")
+
+    # one session per url, reused by different api objects
+    sessions = [c.args[0] for c in post.call_args_list]
+    assert sessions[0] is sessions[2]
+    assert sessions[0] is not sessions[1]
+
+
+def test_batches_adapt_to_server_errors(records_api):
+    api = records_api
+    requested = []
+
+    def fake_export(format_type, records=None, **kwargs):
+        if records == ["record_id"] or format_type == "json":
+            return [{"record_id": str(i)} for i in range(1, 12)]
+        requested.append(len(records))
+        if len(records) > 2:
+            raise RedcapServerError("Internal server error", 500)
+        rows = "".join(f"{r},spam\n" for r in records)
+        return [f"record_id,foo\n{rows}".encode()]
+
+    with patch.object(MyRecords, "export_records", side_effect=fake_export):
+        result = b"".join(api.export_records_batched(batch_size=8))
+
+    rows = "".join(f"{i},spam\n" for i in range(1, 12))
+    assert result == f"record_id,foo\n{rows}".encode()
+    # the first batch is split until requests succeed, and the size
+    # grows again after a few successes
+    assert requested == [8, 4, 2, 2, 2, 2, 3, 1, 1, 1]
+
+    # server errors are recognized as such
+    response = _fake_response([b"Internal server error"], 500)
+    with patch("requests.Session.post", return_value=response):
+        with pytest.raises(RedcapServerError):
+            api.export_records(format_type="csv", fields=["record_id"])
+
+
+def test_transient_errors_are_retried(records_api):
+    api = records_api
+    chunks = [b"record_id\n", b"1\n"]
+    responses = [
+        requests.exceptions.ConnectionError("Connection reset by peer"),
+        _fake_response([b"Service unavailable"], 503),
+        _fake_response(chunks),
+    ]
+
+    with patch("requests.Session.post", side_effect=responses) as post, patch(
+        "datalad_redcap.client.time.sleep"
+    ) as sleep:
+        result = api.export_records(format_type="csv", fields=["record_id"])
+        assert list(result) == chunks
+    assert post.call_count == 3
+    assert api.retries == 2
+    # delays grow exponentially, with jitter
+    delays = [c.args[0] for c in sleep.call_args_list]
+    assert 0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2
+    assert api.retry_wait == sum(delays)
+
+    # other errors, or too many failures, are raised
+    api.max_retries = 1
+    responses = [_fake_response([b"Service unavailable"], 503)] * 2
+    with patch("requests.Session.post", side_effect=responses), patch(
+        "datalad_redcap.client.time.sleep"
+    ):
+        with pytest.raises(RedcapServerError):
+            api.export_records(format_type="csv", fields=["record_id"])
+    response = _fake_response([b"ERROR: You do not have permissions"], 403)
+    with patch("requests.Session.post", return_value=response) as post:
+        with pytest.raises(RedcapError):
+            api.export_records(format_type="csv", fields=["record_id"])
+    assert post.call_count == 1
+
+
+def test_json_requests_are_retried(api_url):
+    from datalad_redcap.client import MyInstruments
+
+    api = MyInstruments(url=api_url, token=TOKEN)
+    # the error page of a proxy is not json
+    responses = [
+        _fake_response([b"<html><body>Bad Gateway</body></html>"], 502),
+        _fake_response([b'[{"instrument_name": "foo"}]']),
+    ]
+    for response in responses:
+        response.content = b"".join(response.iter_content.return_value)
+
+    with patch("requests.Session.post", side_effect=responses) as post, patch(
+        "datalad_redcap.client.time.sleep"
+    ):
+        assert api.export_instruments() == [{"instrument_name": "foo"}]
+    assert post.call_count == 2
+    assert api.retries == 1
+
+    # error messages are still raised as such
+    response = _fake_response([b'{"error": "You do not have permissions"}'])
+    response.content = b'{"error": "You do not have permissions"}'
+    with patch("requests.Session.post", return_value=response):
+        with pytest.raises(RedcapError):
+            api.export_instruments()
@@ -0,0 +1,256 @@
+import json
+from threading import Lock
+import time
+from unittest.mock import patch
+
+from datalad.api import export_redcap_batch
+from datalad.distribution.dataset import Dataset
+from datalad_next.tests.utils import (
+    assert_result_count,
+    assert_status,
+    eq_,
+)
+from datalad.tests.utils_pytest import ok_file_has_content
+
+CSV_CONTENT = "foo,bar,baz\nspam,spam,spam"
+XML_CONTENT = """<?xml version="1.0" encoding="UTF-8" ?>"""
+
+
+def test_export_batch_single_commit(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "url": api_url,
+                "exports": [
+                    {"type": "form", "forms": ["foo"], "outfile": "form.csv"},
+                    {"type": "report", "report": "1234", "outfile": "report.csv"},
+                    {"type": "project_xml", "outfile": "project.xml"},
+                ],
+            }
+        )
+    )
+    nrevs = len(list(ds.repo.get_revisions()))
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_records",
+        return_value=[CSV_CONTENT.encode()],
+    ), patch(
+        "datalad_redcap.client.MyReports.export_report",
+        return_value=[CSV_CONTENT.encode()],
+    ), patch(
+        "datalad_redcap.client.MyProjectInfo.export_project_xml",
+        return_value=[XML_CONTENT.encode()],
+    ):
+        res = export_redcap_batch(
+            manifest=manifest, dataset=ds, metrics_file=tmp_path / "redcap.prom"
+        )
+
+    assert_status("ok", res)
+    assert_result_count(res, 3)
+    ok_file_has_content(ds.pathobj / "form.csv", CSV_CONTENT)
+    ok_file_has_content(ds.pathobj / "report.csv", CSV_CONTENT)
+    ok_file_has_content(ds.pathobj / "project.xml", XML_CONTENT)
+    # everything was saved in a single commit
+    eq_(len(list(ds.repo.get_revisions())), nrevs + 1)
+    assert not ds.repo.dirty
+    # shared steps are timed once, with the first export
+    eq_([r["bytes"] for r in res], [len(CSV_CONTENT)] * 2 + [len(XML_CONTENT)])
+    eq_([set(r["timings"]) >= {"status", "save"} for r in res], [True, False, False])
+    # metrics are written for every export
+    metrics = (tmp_path / "redcap.prom").read_text().splitlines()
+    for labels in (
+        'type="form",name="foo",path="form.csv"',
+        'type="report",name="1234",path="report.csv"',
+        'type="project_xml",path="project.xml"',
+    ):
+        assert f'datalad_redcap_export_success{{url="{api_url}",{labels}}} 1' in metrics
+
+
+def test_export_batch_invalid_export(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "url": api_url,
+                "exports": [
+                    {"type": "report", "outfile": "report.csv"},
+                    {"type": "report", "report": "1234", "outfile": "report.csv"},
+                ],
+            }
+        )
+    )
+
+    with patch(
+        "datalad_redcap.client.MyReports.export_report",
+        return_value=[CSV_CONTENT.encode()],
+    ):
+        res = export_redcap_batch(
+            manifest=manifest,
+            dataset=ds,
+            metrics_file=tmp_path / "redcap.prom",
+            on_failure="ignore",
+        )
+
+    # the invalid export is reported, the valid one is performed
+    assert_result_count(res, 1, status="error")
+    assert_result_count(res, 1, status="ok", action="export_redcap_report")
+    # and both are recorded in the metrics
+    metrics = (tmp_path / "redcap.prom").read_text().splitlines()
+    for labels, success in (
+        ('type="report",path="report.csv"', 0),
+        ('type="report",name="1234",path="report.csv"', 1),
+    ):
+        sample = f'datalad_redcap_export_success{{url="{api_url}",{labels}}}'
+        assert f"{sample} {success}" in metrics
+
+
+def test_export_batch_invalid_options(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "url": api_url,
+                "exports": [
+                    {"type": "form", "forms": "foo", "outfile": "a.csv"},
+                    {
+                        "type": "form",
+                        "forms": ["foo"],
+                        "survey_fields": "maybe",
+                        "outfile": "b.csv",
+                    },
+                    {
+                        "type": "form",
+                        "forms": ["foo"],
+                        "batch_size": 0,
+                        "outfile": "c.csv",
+                    },
+                    {"type": "report", "report": 1234, "outfile": "d.csv"},
+                    {
+                        "type": "form",
+                        "forms": ["foo"],
+                        "survey_fields": "false",
+                        "batch_size": "10",
+                        "outfile": "e.csv",
+                    },
+                ],
+            }
+        )
+    )
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_records_batched",
+        return_value=[CSV_CONTENT.encode()],
+    ) as export_records_batched:
+        res = export_redcap_batch(manifest=manifest, dataset=ds, on_failure="ignore")
+
+    # invalid options are reported before anything is exported
+    assert_result_count(res, 4, status="error", action="export_redcap_batch")
+    for option in ("forms", "survey_fields", "batch_size", "report"):
+        assert any(
+            r["message"].startswith(f"Invalid export option {option}=")
+            for r in res
+            if r["status"] == "error"
+        )
+    # valid options are converted like those of the export command
+    assert_result_count(res, 1, status="ok", action="export_redcap_form")
+    export_records_batched.assert_called_once()
+    eq_(export_records_batched.call_args.args[0], 10)
+    eq_(export_records_batched.call_args.kwargs["export_survey_fields"], False)
+
+
+def test_export_batch_duplicate_outfile(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "url": api_url,
+                "exports": [
+                    {"type": "form", "forms": ["foo"], "outfile": "same.csv"},
+                    {"type": "form", "forms": ["bar"], "outfile": "same.csv"},
+                    {"type": "report", "report": "1234", "outfile": "./same.csv"},
+                ],
+            }
+        )
+    )
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_records",
+        return_value=[CSV_CONTENT.encode()],
+    ) as export_records, patch(
+        "datalad_redcap.client.MyReports.export_report",
+        return_value=[CSV_CONTENT.encode()],
+    ) as export_report:
+        res = export_redcap_batch(manifest=manifest, dataset=ds, on_failure="ignore")
+
+    # only the first export writing the file is performed
+    assert_result_count(res, 1, status="ok", action="export_redcap_form")
+    assert_result_count(res, 2, status="error", path=ds.pathobj / "same.csv")
+    eq_(export_records.call_args.kwargs["forms"], ["foo"])
+    export_report.assert_not_called()
+
+
+def test_export_batch_projects(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    sub = ds.create("sub", result_renderer="disabled")
+    other_url = "https://redcap.example.org/api/"
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(
+        json.dumps(
+            {
+                "projects": [
+                    {
+                        "url": api_url,
+                        "exports": [
+                            {"type": "report", "report": str(i), "outfile": f"{i}.csv"}
+                            for i in range(4)
+                        ],
+                    },
+                    {
+                        "url": other_url,
+                        "credential": "pytest-redcap",
+                        "dataset": "sub",
+                        "exports": [
+                            {"type": "report", "report": "5", "outfile": "5.csv"},
+                        ],
+                    },
+                ],
+            }
+        )
+    )
+
+    # record the largest number of concurrent requests per server
+    running = {}
+    max_running = {}
+    lock = Lock()
+
+    def export_report(self, *args, **kwargs):
+        with lock:
+            running[self.url] = running.get(self.url, 0) + 1
+            max_running[self.url] = max(max_running.get(self.url, 0), running[self.url])
+        time.sleep(0.1)
+        with lock:
+            running[self.url] -= 1
+        return [CSV_CONTENT.encode()]
+
+    with patch(
+        "datalad_redcap.client.MyReports.export_report",
+        autospec=True,
+        side_effect=export_report,
+    ):
+        res = export_redcap_batch(
+            manifest=manifest, dataset=ds, jobs=4, jobs_per_host=2
+        )
+
+    assert_status("ok", res)
+    assert_result_count(res, 5)
+    eq_(max_running, {api_url: 2, other_url: 1})
+    ok_file_has_content(ds.pathobj / "3.csv", CSV_CONTENT)
+    ok_file_has_content(sub.pathobj / "5.csv", CSV_CONTENT)
+    # changes in the subdataset are saved, and registered in the superdataset
+    assert not ds.repo.dirty
+    assert not sub.repo.dirty
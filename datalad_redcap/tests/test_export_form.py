@@ -1,11 +1,19 @@
+from datetime import (
+    datetime,
+    timedelta,
+)
+import time
 from unittest.mock import patch
 
+import pytest
+
 from datalad.api import export_redcap_form
 from datalad.distribution.dataset import Dataset
 from datalad_next.tests.utils import (
     assert_status,
     eq_,
 )
+from datalad.tests.utils_pytest import ok_file_has_content
 
 CSV_CONTENT = "foo,bar,baz\nspam,spam,spam"
 
@@ -15,7 +23,8 @@ def test_export_writes_file(tmp_path, api_url, credman_filled):
     fname = "form.csv"
 
     with patch(
-        "datalad_redcap.export_form.Records.export_records", return_value=CSV_CONTENT
+        "datalad_redcap.client.MyRecords.export_records",
+        return_value=[CSV_CONTENT.encode()],
     ):
         res = export_redcap_form(
             url=api_url,
@@ -28,4 +37,175 @@ def test_export_writes_file(tmp_path, api_url, credman_filled):
     assert_status("ok", res)
 
     # check that the file was created and left in clean state
+    ok_file_has_content(tmp_path.joinpath(fname), CSV_CONTENT)
+    eq_(ds.status(fname, return_type="item-or-list").get("state"), "clean")
+
+    # check that timings and sizes are reported
+    eq_(res[0]["bytes"], len(CSV_CONTENT))
+    eq_(res[0]["rows"], 1)
+    eq_(
+        set(res[0]["timings"]),
+        {"status", "credentials", "request", "download", "write", "save"},
+    )
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_export_batched(tmp_path, api_url, credman_filled, jobs):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    fname = "form.csv"
+
+    def fake_export(format_type, records=None, **kwargs):
+        # one row per requested record, each response with a header;
+        # the first batch is the slowest, to check ordering with jobs
+        if "1" in records:
+            time.sleep(0.1)
+        rows = "".join(f"{r},spam\n" for r in records)
+        return [f"record_id,foo\n{rows}".encode()]
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_record_ids",
+        return_value=["1", "2", "3", "4", "5"],
+    ), patch(
+        "datalad_redcap.client.MyRecords.export_records",
+        side_effect=fake_export,
+    ) as export_records:
+        res = export_redcap_form(
+            url=api_url,
+            forms=["foo"],
+            outfile=fname,
+            dataset=ds,
+            batch_size=2,
+            jobs=jobs,
+        )
+
+    assert_status("ok", res)
+    eq_(export_records.call_count, 3)
+    # batches are stitched together with a single header
+    ok_file_has_content(
+        tmp_path.joinpath(fname),
+        "record_id,foo\n1,spam\n2,spam\n3,spam\n4,spam\n5,spam\n",
+    )
+
+
+def test_export_incremental(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    fname = "form.csv"
+    initial = 'record_id,redcap_event_name,foo\n1,ev1,spam\n1,ev2,"ham\nand eggs"\n'
+    delta = "record_id,redcap_event_name,foo\n1,ev2,eggs\n2,ev1,spam\n"
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_records",
+        return_value=[initial.encode()],
+    ) as export_records:
+        export_redcap_form(
+            url=api_url,
+            forms=["foo"],
+            outfile=fname,
+            dataset=ds,
+            incremental=True,
+        )
+    # no previous export, so everything was requested
+    assert "date_begin" not in export_records.call_args.kwargs
+    ok_file_has_content(tmp_path.joinpath(fname), initial)
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_records",
+        return_value=[delta.encode()],
+    ) as export_records:
+        res = export_redcap_form(
+            url=api_url,
+            forms=["foo"],
+            outfile=fname,
+            dataset=ds,
+            incremental=True,
+        )
+    assert_status("ok", res)
+    # only changes were requested, and merged into the existing file
+    assert export_records.call_args.kwargs["date_begin"] is not None
+    ok_file_has_content(
+        tmp_path.joinpath(fname),
+        "record_id,redcap_event_name,foo\n1,ev1,spam\n1,ev2,eggs\n2,ev1,spam\n",
+    )
     eq_(ds.status(fname, return_type="item-or-list").get("state"), "clean")
+
+
+@pytest.mark.parametrize("overlap", [None, 3600])
+def test_export_incremental_overlap(tmp_path, api_url, credman_filled, overlap):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    if overlap is not None:
+        ds.config.set(
+            "datalad.redcap.incremental-overlap", str(overlap), scope="local"
+        )
+    expected = timedelta(seconds=overlap if overlap is not None else 2 * 24 * 3600)
+    content = b"record_id,foo\n1,spam\n"
+
+    for _ in range(2):
+        started = datetime.now().replace(microsecond=0)
+        with patch(
+            "datalad_redcap.client.MyRecords.export_records",
+            return_value=[content],
+        ) as export_records:
+            export_redcap_form(
+                url=api_url,
+                forms=["foo"],
+                outfile="form.csv",
+                dataset=ds,
+                incremental=True,
+            )
+    # changes are requested from before the previous export started,
+    # by the configured overlap
+    date_begin = export_records.call_args.kwargs["date_begin"]
+    assert started - expected - timedelta(seconds=60) < date_begin
+    assert date_begin <= started - expected
+
+
+def test_export_dry_run(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    fname = "form.csv"
+    metadata = [
+        {"field_name": "record_id", "form_name": "foo", "field_type": "text"},
+        {"field_name": "intro", "form_name": "foo", "field_type": "descriptive"},
+        {
+            "field_name": "colors",
+            "form_name": "foo",
+            "field_type": "checkbox",
+            "select_choices_or_calculations": "1, Red | 2, Green | 3, Blue",
+        },
+        {"field_name": "other", "form_name": "bar", "field_type": "text"},
+    ]
+
+    with patch(
+        "datalad_redcap.client.MyRecords.export_record_id_rows",
+        return_value=["1", "1", "2"],
+    ), patch(
+        "datalad_redcap.client.MyMetadata.export_metadata",
+        return_value=metadata,
+    ), patch(
+        "datalad_redcap.client.MyRecords.export_records",
+    ) as export_records:
+        res = export_redcap_form(
+            url=api_url,
+            forms=["foo"],
+            outfile=fname,
+            dataset=ds,
+            survey_fields=False,
+            batch_size=1,
+            dry_run=True,
+        )
+
+    assert_status("ok", res)
+    # record_id, 3 checkbox columns, and foo_complete
+    eq_(
+        res[0]["plan"],
+        dict(
+            records=2,
+            rows=3,
+            columns=5,
+            bytes=120,
+            requests=3,
+            recommended_batch_size=None,
+        ),
+    )
+    # no records were exported, nothing was written
+    export_records.assert_not_called()
+    assert not (tmp_path / fname).exists()
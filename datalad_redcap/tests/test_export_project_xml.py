@@ -16,8 +16,8 @@ def test_export_xml_saves_content(tmp_path, api_url, credman_filled):
     fname = "project.xml"
 
     with patch(
-        "datalad_redcap.export_project_xml.ProjectInfo.export_project_xml",
-        return_value=XML_CONTENT,
+        "datalad_redcap.client.MyProjectInfo.export_project_xml",
+        return_value=[XML_CONTENT.encode()],
     ):
         res = export_redcap_project_xml(
             url=api_url,
@@ -1,11 +1,15 @@
 from unittest.mock import patch
 
+import pytest
+from redcap import RedcapError
+
 from datalad.api import export_redcap_report
 from datalad.distribution.dataset import Dataset
 from datalad_next.tests.utils import (
     assert_status,
     eq_,
 )
+from datalad.tests.utils_pytest import ok_file_has_content
 
 CSV_CONTENT = "foo,bar,baz\nspam,spam,spam"
 
@@ -15,7 +19,8 @@ def test_export_writes_file(tmp_path, api_url, credman_filled):
     fname = "report.csv"
 
     with patch(
-        "datalad_redcap.export_report.Reports.export_report", return_value=CSV_CONTENT
+        "datalad_redcap.client.MyReports.export_report",
+        return_value=[CSV_CONTENT.encode()],
     ):
         res = export_redcap_report(
             url=api_url,
@@ -28,4 +33,80 @@ def test_export_writes_file(tmp_path, api_url, credman_filled):
     assert_status("ok", res)
 
     # check that the file was created and left in clean state
+    ok_file_has_content(tmp_path.joinpath(fname), CSV_CONTENT)
+    eq_(ds.status(fname, return_type="item-or-list").get("state"), "clean")
+
+
+def test_export_unchanged_not_saved(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    fname = "report.csv"
+
+    for expected_status in ("ok", "notneeded"):
+        with patch(
+            "datalad_redcap.client.MyReports.export_report",
+            return_value=[CSV_CONTENT.encode()],
+        ):
+            res = export_redcap_report(
+                url=api_url,
+                report="1234",
+                outfile=fname,
+                dataset=ds,
+            )
+        assert_status(expected_status, res)
+
+    # the second export did not create a commit
+    eq_(len(list(ds.repo.get_revisions())), 2)
     eq_(ds.status(fname, return_type="item-or-list").get("state"), "clean")
+
+
+def test_export_writes_metrics(tmp_path, api_url, credman_filled):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    metrics_file = tmp_path / "metrics" / "redcap.prom"
+    labels = f'url="{api_url}",type="report",name="1234",path="report.csv"'
+
+    with patch(
+        "datalad_redcap.client.MyReports.export_report",
+        return_value=[CSV_CONTENT.encode()],
+    ):
+        export_redcap_report(
+            url=api_url,
+            report="1234",
+            outfile="report.csv",
+            dataset=ds,
+            metrics_file=metrics_file,
+        )
+    metrics = metrics_file.read_text().splitlines()
+    assert f"datalad_redcap_export_bytes{{{labels}}} {len(CSV_CONTENT)}" in metrics
+    assert f"datalad_redcap_export_rows{{{labels}}} 1" in metrics
+    assert f"datalad_redcap_export_success{{{labels}}} 1" in metrics
+    eq_(metrics[-1], "# EOF")
+
+    # failures are recorded too
+    with patch(
+        "datalad_redcap.client.MyReports.export_report",
+        side_effect=RedcapError("Server unavailable"),
+    ), pytest.raises(RedcapError):
+        export_redcap_report(
+            url=api_url,
+            report="1234",
+            outfile="report.csv",
+            dataset=ds,
+            metrics_file=metrics_file,
+        )
+    metrics = metrics_file.read_text().splitlines()
+    assert f"datalad_redcap_export_success{{{labels}}} 0" in metrics
+    assert not any(m.startswith("datalad_redcap_export_bytes") for m in metrics)
+
+    # as are exports which can not start, e.g. with an untracked file
+    (ds.pathobj / "untracked.csv").write_text("unsaved changes")
+    export_redcap_report(
+        url=api_url,
+        report="1234",
+        outfile="untracked.csv",
+        dataset=ds,
+        metrics_file=metrics_file,
+        on_failure="ignore",
+    )
+    metrics = metrics_file.read_text().splitlines()
+    labels = labels.replace("report.csv", "untracked.csv")
+    assert f"datalad_redcap_export_success{{{labels}}} 0" in metrics
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+# modules needed only when a command runs, not when it is loaded
+DEFERRED_MODULES = ("redcap", "prettytable", "aiohttp")
+
+
+def test_command_modules_defer_imports():
+    # run in a fresh interpreter, as other tests import everything
+    code = "\n".join(
+        [
+            "import sys",
+            "import datalad_redcap",
+            "from datalad_redcap import command_suite",
+            "from importlib import import_module",
+            "for spec in command_suite[1]:",
+            "    import_module(spec[0])",
+            f"print(' '.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))",
+        ]
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert out.stdout.split() == []
@@ -27,8 +27,8 @@ def test_url_rejected(tmp_path, credman_filled, api_url):
 
     with pytest.raises(ConstraintError):
         with patch(
-            "datalad_redcap.export_form.Records.export_records",
-            return_value=CSV_CONTENT,
+            "datalad_redcap.client.MyRecords.export_records",
+            return_value=[CSV_CONTENT.encode()],
         ):
             export_redcap_form(
                 url="example.com",  # missing scheme, path
@@ -45,8 +45,8 @@ def test_dataset_not_found(tmp_path, credman_filled, api_url):
     # explicit path that isn't a dataset
     with pytest.raises(ConstraintError):
         with patch(
-            "datalad_redcap.export_form.Records.export_records",
-            return_value=CSV_CONTENT,
+            "datalad_redcap.client.MyRecords.export_records",
+            return_value=[CSV_CONTENT.encode()],
         ):
             export_redcap_form(
                 url=api_url,
@@ -59,8 +59,8 @@ def test_dataset_not_found(tmp_path, credman_filled, api_url):
     with chpwd(tmp_path, mkdir=True):
         with pytest.raises(ConstraintError):
             with patch(
-                "datalad_redcap.export_form.Records.export_records",
-                return_value=CSV_CONTENT,
+                "datalad_redcap.client.MyRecords.export_records",
+                return_value=[CSV_CONTENT.encode()],
             ):
                 export_redcap_form(
                     url=api_url,
@@ -1,8 +1,10 @@
 from unittest.mock import patch
 
 from datalad.api import redcap_query
+from datalad.distribution.dataset import Dataset
 from datalad_next.tests.utils import (
     assert_result_count,
+    eq_,
 )
 
 JSON_CONTENT = {"foo": "bar"}
@@ -10,7 +12,100 @@ JSON_CONTENT = {"foo": "bar"}
 
 def test_redcap_query_has_result(credman_filled, api_url):
     with patch(
-        "datalad_redcap.query.MyInstruments.export_instruments",
+        "datalad_redcap.client.MyInstruments.export_instruments",
         return_value=JSON_CONTENT,
     ):
         assert_result_count(redcap_query(url=api_url, result_renderer="disabled"), 1)
+
+
+def test_redcap_query_cached(credman_filled, api_url, metadata_cache):
+    with patch(
+        "datalad_redcap.client.MyInstruments.export_instruments",
+        return_value=[JSON_CONTENT],
+    ) as export_instruments:
+        res = redcap_query(url=api_url, result_renderer="disabled")
+        # second query is answered from the cache
+        res_cached = redcap_query(url=api_url, result_renderer="disabled")
+        eq_(export_instruments.call_count, 1)
+        eq_(res_cached[0]["instruments"], res[0]["instruments"])
+        # unless a refresh is requested
+        redcap_query(url=api_url, refresh=True, result_renderer="disabled")
+        eq_(export_instruments.call_count, 2)
+        # or caching is disabled
+        with patch("datalad_redcap.cache.get_ttl", return_value=0):
+            redcap_query(url=api_url, result_renderer="disabled")
+        eq_(export_instruments.call_count, 3)
+    assert any(metadata_cache.rglob("instruments.json"))
+
+
+METADATA = [
+    {
+        "field_name": "record_id",
+        "form_name": "demographics",
+        "field_type": "text",
+        "field_label": "Record ID",
+        "select_choices_or_calculations": "",
+    },
+    {
+        "field_name": "sex",
+        "form_name": "demographics",
+        "field_type": "radio",
+        "field_label": "Sex",
+        "select_choices_or_calculations": "1, Female | 2, Male | 3, Other, specify",
+    },
+    {
+        "field_name": "bmi_value",
+        "form_name": "measurements",
+        "field_type": "calc",
+        "field_label": "BMI",
+        "select_choices_or_calculations": "[weight]/([height]^2)",
+    },
+]
+
+
+def test_redcap_query_fields(credman_filled, api_url):
+    with patch(
+        "datalad_redcap.client.MyMetadata.export_metadata",
+        return_value=METADATA,
+    ) as export_metadata:
+        res = redcap_query(url=api_url, fields=["sex"], result_renderer="disabled")
+        eq_(len(res[0]["fields"]), 1)
+        eq_(res[0]["fields"][0]["form_name"], "demographics")
+        eq_(
+            res[0]["fields"][0]["choices"],
+            {"1": "Female", "2": "Male", "3": "Other, specify"},
+        )
+
+        # patterns are matched against the cached index
+        res = redcap_query(
+            url=api_url, fields=["bmi_*", "record_*"], result_renderer="disabled"
+        )
+        eq_([f["field_name"] for f in res[0]["fields"]], ["record_id", "bmi_value"])
+        eq_(res[0]["fields"][1]["choices"], None)
+        eq_(export_metadata.call_count, 1)
+
+
+def test_redcap_query_dataset_config(tmp_path, credman_filled, api_url):
+    ds = Dataset(tmp_path).create(result_renderer="disabled")
+    ds.config.set("datalad.redcap.rate-limit", "300", scope="local")
+    limiters = []
+
+    def export_instruments(self, *args, **kwargs):
+        limiters.append(self._rate_limiter)
+        return [JSON_CONTENT]
+
+    with patch(
+        "datalad_redcap.client.MyInstruments.export_instruments",
+        autospec=True,
+        side_effect=export_instruments,
+    ):
+        # without a dataset, the local configuration is not read
+        redcap_query(url=api_url, refresh=True, result_renderer="disabled")
+        res = redcap_query(
+            url=api_url, dataset=ds, refresh=True, result_renderer="disabled"
+        )
+    eq_(limiters[0], None)
+    # with it, requests share the rate limit of the dataset
+    eq_(limiters[1].rate, 300)
+    eq_(limiters[1].state_file.parent.parent, ds.repo.dot_git)
+    eq_(res[0]["path"], ds.path)
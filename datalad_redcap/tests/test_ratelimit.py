@@ -0,0 +1,45 @@
+from datalad.distribution.dataset import Dataset
+
+from datalad_redcap.ratelimit import (
+    RateLimiter,
+    get_rate_limiter,
+)
+
+TOKEN = "WTJ3G8XWO9G8V1BB4K8N81KNGRPFJOVL"
+
+
+def test_rate_limiter_is_shared(tmp_path, api_url):
+    state_file = tmp_path / "ratelimit.json"
+    limiter = RateLimiter(api_url, TOKEN, 2, state_file)
+    # a burst of up to the rate is allowed
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+
+    # the bucket is empty for other users of the state file too, and
+    # refills at one request per 30 seconds
+    other = RateLimiter(api_url, TOKEN, 2, state_file)
+    assert 29 < other._take() <= 30
+
+    # but not for other tokens
+    other_token = RateLimiter(api_url, TOKEN[::-1], 2, state_file)
+    assert other_token._take() == 0
+
+
+def test_get_rate_limiter(tmp_path, api_url):
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    assert get_rate_limiter(api_url, TOKEN, ds) is None
+
+    ds.config.set("datalad.redcap.rate-limit", "600", scope="local")
+    limiter = get_rate_limiter(api_url, TOKEN, ds)
+    assert limiter.rate == 600
+    limiter.acquire()
+    # state is kept in the dataset's .git directory
+    assert limiter.state_file.exists()
+    assert ds.repo.dot_git in limiter.state_file.parents
+
+
+def test_rate_limiter_below_one_per_minute(tmp_path, api_url):
+    limiter = RateLimiter(api_url, TOKEN, 0.5, tmp_path / "ratelimit.json")
+    assert limiter.acquire() == 0
+    # the next token takes two minutes
+    assert 119 < limiter._take() <= 120
@@ -0,0 +1,41 @@
+import time
+
+from datalad_next.tests.utils import eq_
+
+from datalad_redcap.stats import (
+    CommandStats,
+    CsvRowCounter,
+)
+
+
+def test_nested_phases():
+    stats = CommandStats()
+    with stats.phase("write"):
+        time.sleep(0.05)
+        chunks = list(stats.count(_slow_chunks([b"a,b\n", b"1,2\n"], 0.05)))
+    eq_(chunks, [b"a,b\n", b"1,2\n"])
+    eq_(stats.bytes, 8)
+    # waiting for chunks does not count toward the enclosing phase
+    assert stats.timings["download"] >= 0.1
+    assert 0.05 <= stats.timings["write"] < 0.15
+    eq_(set(stats.result_props()), {"timings", "bytes"})
+
+
+def test_csv_row_counter():
+    content = b'id,text\n1,"two\nlines"\n2,"a ""quoted"" word"\n3,last'
+    # the count does not depend on how the content is split into chunks
+    for size in (1, 3, 7, len(content)):
+        counter = CsvRowCounter()
+        for i in range(0, len(content), size):
+            counter.update(content[i : i + size])
+        eq_(counter.rows, 3)
+
+    counter = CsvRowCounter()
+    counter.update(b"id,text\n")
+    eq_(counter.rows, 0)
+
+
+def _slow_chunks(chunks, delay):
+    for chunk in chunks:
+        time.sleep(delay)
+        yield chunk
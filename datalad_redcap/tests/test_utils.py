@@ -1,6 +1,21 @@
+from unittest.mock import (
+    MagicMock,
+    patch,
+)
+
+import pytest
+
+from datalad.api import clone
 from datalad.distribution.dataset import Dataset
 
-from datalad_redcap.utils import check_ok_to_edit
+from datalad_redcap.utils import (
+    check_ok_to_edit,
+    check_ok_to_edit_many,
+    invalidate_credentials,
+    obtain_credential,
+    update_credentials,
+    write_if_changed,
+)
 
 
 def test_check_ok_to_edit(tmp_path):
@@ -35,3 +50,153 @@ def test_check_ok_to_edit(tmp_path):
     inside.write_text("new dummy")
     ok2ed, _ = check_ok_to_edit(inside, ds)
     assert not ok2ed
+
+
+def test_check_ok_to_edit_many(tmp_path):
+    """Tests that many paths are checked with one status query"""
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    ds.create("subds", result_renderer="disabled")
+    for name in ("clean", "modified", "dir/file"):
+        (ds.pathobj / name).parent.mkdir(exist_ok=True)
+        (ds.pathobj / name).write_text("dummy")
+    ds.save(recursive=True, result_renderer="disabled")
+    ds.unlock("modified", result_renderer="disabled")
+    (ds.pathobj / "modified").write_text("new dummy")
+
+    paths = [
+        tmp_path / "file_outside",
+        ds.pathobj / "subds" / "../clean",
+        ds.pathobj / "new",
+        ds.pathobj / "modified",
+        ds.pathobj / "subds" / "subds_file",
+        ds.pathobj / "dir",
+    ]
+    with patch.object(
+        type(ds.repo), "status", autospec=True, side_effect=type(ds.repo).status
+    ) as status:
+        decisions = check_ok_to_edit_many(paths, ds)
+    assert status.call_count == 1
+    assert [ok2ed for ok2ed, _ in decisions] == [
+        False,
+        True,
+        True,
+        False,
+        False,
+        False,
+    ]
+    # same decisions as checking paths one by one
+    assert decisions == [check_ok_to_edit(p, ds) for p in paths]
+
+
+@pytest.mark.parametrize("annex", [True, False])
+def test_write_if_changed(tmp_path, annex):
+    """Tests that unchanged content is recognized, without annex content"""
+    origin = Dataset(tmp_path / "origin").create(
+        annex=annex, result_renderer="disabled"
+    )
+    (origin.pathobj / "file.csv").write_text("foo,bar\n")
+    origin.save()
+    # in a clone, annexed content is not present
+    ds = clone(source=origin.path, path=tmp_path / "ds", result_renderer="disabled")
+    fpath = ds.pathobj / "file.csv"
+    ok2ed, _ = check_ok_to_edit(fpath, ds)
+    assert ok2ed
+
+    # same content: file is not touched
+    assert not write_if_changed([b"foo,", b"bar\n"], fpath, ds)
+    assert ds.status(fpath, return_type="item-or-list")["state"] == "clean"
+
+    # new content (even of the same size): file is replaced, and this
+    # does not need the old annexed content either
+    assert write_if_changed([b"foo,baz\n"], fpath, ds)
+    assert fpath.read_text() == "foo,baz\n"
+    assert ds.status(fpath, return_type="item-or-list")["state"] == "modified"
+
+    # new content is annexed on save
+    ds.save(fpath)
+    assert fpath.is_symlink() == annex
+    assert ds.status(fpath, return_type="item-or-list")["state"] == "clean"
+
+    # no temporary files are left behind
+    assert list(fpath.parent.glob(".file.csv.*")) == []
+
+
+def test_write_if_changed_interrupted(tmp_path):
+    """Tests that a failed download leaves no partial or temporary files"""
+    ds = Dataset(tmp_path / "ds").create(result_renderer="disabled")
+    existing = ds.pathobj / "existing.csv"
+    existing.write_text("foo,bar\n")
+    ds.save()
+
+    def failing_stream():
+        yield b"foo,"
+        raise ConnectionError("connection dropped")
+
+    for fpath in (existing, ds.pathobj / "new.csv"):
+        with pytest.raises(ConnectionError):
+            write_if_changed(failing_stream(), fpath, ds)
+
+    # existing file is intact, new file was not created
+    assert ds.status(existing, return_type="item-or-list")["state"] == "clean"
+    assert not (ds.pathobj / "new.csv").exists()
+    assert list(ds.pathobj.glob(".*.part")) == []
+
+
+def test_update_credentials_once(api_url):
+    credman = MagicMock()
+    credprops = {"type": "token", "secret": "dummy", "realm": api_url}
+    with patch("datalad_redcap.utils._lastused_updated", set()):
+        # the last used date is updated once per credential
+        update_credentials(credman, "pytest-once", credprops)
+        update_credentials(credman, "pytest-once", credprops)
+        assert credman.set.call_count == 1
+        update_credentials(credman, "pytest-other", credprops)
+        assert credman.set.call_count == 2
+
+        # new and edited credentials are always saved
+        update_credentials(credman, None, credprops)
+        update_credentials(credman, None, credprops)
+        update_credentials(credman, "pytest-once", {**credprops, "_edited": True})
+        assert credman.set.call_count == 5
+
+
+def test_obtain_credential_cached(api_url, credman_filled):
+    with patch.object(
+        type(credman_filled),
+        "obtain",
+        autospec=True,
+        side_effect=type(credman_filled).obtain,
+    ) as obtain:
+        credname, credprops = obtain_credential(credman_filled, api_url)
+        assert credname == "pytest-redcap"
+        # the second lookup, also with a new manager, is answered from memory
+        assert obtain_credential(type(credman_filled)(), api_url) == (
+            credname,
+            credprops,
+        )
+        assert obtain.call_count == 1
+        # a different name is a different lookup
+        obtain_credential(credman_filled, api_url, "pytest-redcap")
+        assert obtain.call_count == 2
+
+        invalidate_credentials(name="pytest-redcap")
+        obtain_credential(credman_filled, api_url)
+        obtain_credential(credman_filled, api_url, "pytest-redcap")
+        assert obtain.call_count == 4
+
+
+def test_obtain_credential_cached_per_dataset(tmp_path, api_url, credman_filled):
+    # datasets can have credentials of their own
+    ds1 = Dataset(tmp_path / "ds1").create(result_renderer="disabled")
+    ds2 = Dataset(tmp_path / "ds2").create(result_renderer="disabled")
+    with patch.object(
+        type(credman_filled),
+        "obtain",
+        autospec=True,
+        side_effect=type(credman_filled).obtain,
+    ) as obtain:
+        for ds in (ds1, ds1, ds2):
+            obtain_credential(credman_filled, api_url, ds=ds)
+        assert obtain.call_count == 2
+        obtain_credential(credman_filled, api_url)
+        assert obtain.call_count == 3
@@ -1,18 +1,106 @@
 """Utility methods"""
 
+import hashlib
 import logging
+import os
 from pathlib import Path
+from threading import Lock
 from typing import (
+    Dict,
+    Iterable,
+    List,
     Optional,
+    Set,
     Tuple,
 )
+from uuid import uuid4
 
 from datalad.distribution.dataset import Dataset
+from datalad.support.annexrepo import AnnexRepo
+from datalad.log import log_progress
 from datalad_next.exceptions import CapturedException
 from datalad_next.utils import CredentialManager
 
 lgr = logging.getLogger("datalad.redcap.utils")
 
+# names of credentials whose last used date was updated in this process
+_lastused_updated: Set[str] = set()
+
+# credentials obtained in this process, by realm, requested name, and
+# dataset whose configuration was searched (None for global)
+_credentials: Dict[
+    Tuple[str, Optional[str], Optional[str]], Tuple[Optional[str], dict]
+] = {}
+_credentials_lock = Lock()
+
+# git-annex backends which can be verified with hashlib
+ANNEX_HASH_BACKENDS = {
+    "MD5": "md5",
+    "SHA1": "sha1",
+    "SHA224": "sha224",
+    "SHA256": "sha256",
+    "SHA384": "sha384",
+    "SHA512": "sha512",
+}
+
+
+def obtain_credential(
+    credman: CredentialManager,
+    url: str,
+    name: Optional[str] = None,
+    ds: Optional[Dataset] = None,
+) -> Tuple[Optional[str], dict]:
+    """Obtain a credential with a token for the API url, and cache it
+
+    Uses CredentialManager.obtain() with the url as realm, prompting
+    for a token if no credential is found. ``ds`` is the dataset whose
+    configuration the credential manager uses, if any. Credentials
+    found that way are kept in memory for the rest of the process, by
+    url, requested name (which may be None), and dataset (as datasets
+    can have credentials of their own), so that later calls do not
+    have to query all credentials again. Credentials entered at the
+    prompt are not cached before they are saved (see
+    update_credentials). Use invalidate_credentials after changing
+    credentials in the same process.
+    """
+    key = (url, name, None if ds is None else str(ds.pathobj))
+    with _credentials_lock:
+        cached = _credentials.get(key)
+    if cached is not None:
+        return cached[0], dict(cached[1])
+
+    credname, credprops = credman.obtain(
+        name=name,
+        prompt="A token is required to access the REDCap project API",
+        type_hint="token",
+        query_props={"realm": url},
+        expected_props=("secret",),
+    )
+    if not credprops.get("_edited"):
+        with _credentials_lock:
+            _credentials[key] = (credname, dict(credprops))
+    return credname, credprops
+
+
+def invalidate_credentials(url: Optional[str] = None, name: Optional[str] = None):
+    """Forget cached credentials, for a given url and/or credential name
+
+    Without arguments, all cached credentials are forgotten. Also
+    forgets that the last used date of the affected credentials was
+    updated.
+    """
+    with _credentials_lock:
+        for key, (credname, _) in list(_credentials.items()):
+            if (url is None or key[0] == url) and (
+                name is None or name in (key[1], credname)
+            ):
+                del _credentials[key]
+                _lastused_updated.discard(credname)
+        if url is None and name is None:
+            _lastused_updated.clear()
+        elif name is not None:
+            _lastused_updated.discard(name)
+
 
 def update_credentials(
     credman: CredentialManager, credname: Optional[str], credprops: dict
@@ -22,7 +110,14 @@ def update_credentials(
     Saves a new credential or just updates last used date. Uses
     CredentialManager.set(), deescalating errors to warnings. Suggests
     "redcap-<api url>" as default name.
+
+    The last used date of a known, unchanged credential is updated only
+    once per process, as every update rewrites the configuration.
     """
+    coalesce = credname is not None and not credprops.get("_edited")
+    if coalesce and credname in _lastused_updated:
+        lgr.debug("Last used date of credential %r already updated", credname)
+        return
     try:
         credman.set(
             name=credname,
@@ -37,6 +132,9 @@ def update_credentials(
     except Exception as e:
         msg = ("Exception raised when storing credential %r %r: %s",)
         lgr.warn(msg, credname, credprops, CapturedException(e))
+        return
+    if coalesce:
+        _lastused_updated.add(credname)
 
 
 def check_ok_to_edit(filepath: Path, ds: Dataset) -> Tuple[bool, bool]:
@@ -44,29 +142,188 @@ def check_ok_to_edit(filepath: Path, ds: Dataset) -> Tuple[bool, bool]:
 
     Only allows paths that are within the given dataset (not outside, not in
     a subdatset) and lead either to existing clean files or nonexisting files.
-    Uses ds.repo.status.
+    Uses ds.repo.status. See check_ok_to_edit_many for checking many files.
+    """
+    return check_ok_to_edit_many([filepath], ds)[0]
+
+
+def check_ok_to_edit_many(
+    filepaths: Iterable[Path], ds: Dataset
+) -> List[Tuple[bool, bool]]:
+    """Check if it's ok to write to files, and if they need unlocking
+
+    Same as check_ok_to_edit, but for many files at once, with a single
+    call to ds.repo.status. Returns a tuple (ok_to_edit, unlock) for
+    each path, in the given order.
     """
+    root = ds.repo.pathobj
+    paths = [Path(os.path.normpath(root / fp)) for fp in filepaths]
+    inside = [p for p in paths if root in p.parents]
+    if not inside:
+        return [(False, False)] * len(paths)
+
     try:
-        st = ds.repo.status(paths=[filepath])
+        st = ds.repo.status(paths=inside)
     except ValueError:
-        # path outside the dataset
-        return False, False
+        # a path is outside the dataset after all (e.g. through a
+        # symlink), let status decide for every path separately
+        if len(paths) == 1:
+            return [(False, False)]
+        return [check_ok_to_edit(p, ds) for p in paths]
 
-    if st == {}:
-        # path is fine, file doesn't exist
-        ok_to_edit = True
-        unlock = False
-    else:
-        assert len(st) == 1
-        st_fp = next(iter(st.values()))
-        if st_fp["type"] == "file" and st_fp["state"] == "clean":
-            ok_to_edit = True
-            unlock = False
+    # status reports on the paths, on subdatasets containing them, or
+    # on files underneath them (if they are directories)
+    st_parents = {parent for st_path in st for parent in st_path.parents}
+
+    decisions = []
+    for path in paths:
+        if root not in path.parents or path in st_parents:
+            decisions.append((False, False))
+            continue
+        st_fp = next(
+            (st[p] for p in (path, *path.parents) if p in st),
+            None,
+        )
+        if st_fp is None:
+            # path is fine, file doesn't exist
+            decisions.append((True, False))
+        elif st_fp["type"] == "file" and st_fp["state"] == "clean":
+            decisions.append((True, False))
         elif st_fp["type"] == "symlink" and st_fp["state"] == "clean":
-            ok_to_edit = True
-            unlock = True
+            decisions.append((True, True))
         else:
             # note: paths pointing into subdatasets have type=dataset
-            ok_to_edit = False
-            unlock = False
-    return ok_to_edit, unlock
+            decisions.append((False, False))
+    return decisions
+
+
+def get_content_id(filepath: Path, ds: Dataset) -> Optional[Tuple[str, int, str]]:
+    """Identify the saved content of a file, without reading it
+
+    Returns a tuple of hash algorithm, size, and checksum of the
+    content, based on the annex key for annexed files, or on the git
+    blob id for files in git (algorithm reported as "gitblob").
+    Returns None if the file does not exist, or if it is annexed with a
+    backend which can not be verified by hashing.
+    """
+    if not os.path.lexists(filepath):
+        return None
+
+    if isinstance(ds.repo, AnnexRepo):
+        annexinfo = ds.repo.get_file_annexinfo(filepath)
+        if annexinfo.get("key") is not None:
+            algorithm = ANNEX_HASH_BACKENDS.get(annexinfo["backend"].rstrip("E"))
+            if algorithm is None:
+                return None
+            checksum = annexinfo["keyname"].split(".", maxsplit=1)[0]
+            return algorithm, annexinfo["bytesize"], checksum
+
+    gitinfo = ds.repo.get_content_info(paths=[filepath], ref=None)
+    gitshasum = next(iter(gitinfo.values()), {}).get("gitshasum")
+    if gitshasum is None:
+        return None
+    # the file is clean, so its size is the size of the blob
+    return "gitblob", filepath.stat().st_size, gitshasum
+
+
+def write_if_changed(
+    chunks: Iterable[bytes],
+    filepath: Path,
+    ds: Dataset,
+    label: str = "Downloading",
+) -> bool:
+    """Write chunks to a file, unless they match its saved content
+
+    Chunks are written to a temporary file in the same directory, and
+    hashed in the process. Only once all chunks were written, the file
+    is replaced by the temporary file, so an interrupted download never
+    leaves a partial file in its place (and the temporary file is
+    removed on errors). If the content is the same as the saved content
+    of the file (see get_content_id), the temporary file is removed,
+    and the file is left untouched (annexed content does not need to be
+    present for that). Returns True if the file was written, and False
+    if it was not.
+
+    Annexed files are not unlocked before replacing them: unlocking
+    would copy the old content only to overwrite it. The symlink is
+    replaced with the new file, which gets annexed on save.
+    """
+    content_id = get_content_id(filepath, ds)
+    if content_id is None:
+        hasher = None
+    elif content_id[0] == "gitblob":
+        # git hashes a header with the size, which is known in advance:
+        # if the new content has a different size, the hash won't match
+        hasher = hashlib.sha1(b"blob %d\0" % content_id[1])
+    else:
+        hasher = hashlib.new(content_id[0])
+
+    tmpfile = filepath.with_name(f".{filepath.name}.{uuid4().hex[:8]}.part")
+    try:
+        nbytes = write_stream(chunks, tmpfile, label=label, hasher=hasher)
+        if content_id is not None and (nbytes, hasher.hexdigest()) == content_id[1:]:
+            lgr.debug("Content of %s did not change, not writing", filepath)
+            tmpfile.unlink()
+            return False
+        os.replace(tmpfile, filepath)
+    except BaseException:
+        # also catches interruptions, e.g. KeyboardInterrupt
+        tmpfile.unlink(missing_ok=True)
+        raise
+    return True
+
+
+def write_stream(
+    chunks: Iterable[bytes],
+    filepath: Path,
+    label: str = "Downloading",
+    hasher: Optional["hashlib._Hash"] = None,
+) -> int:
+    """Write chunks of bytes to a file as they arrive
+
+    Used to save API responses without holding them in memory. The
+    content is written as received (in binary mode), so line endings
+    are the same as sent by the server. Progress is reported in bytes,
+    under the given label. If a hasher object is given, it is updated
+    with each chunk. The file is synced to disk before returning.
+    Returns the number of bytes written.
+    """
+    pid = f"redcap_download_{filepath}"
+    log_progress(
+        lgr.info,
+        pid,
+        "Start writing %s",
+        filepath,
+        label=label,
+        unit=" Bytes",
+        noninteractive_level=logging.DEBUG,
+    )
+    nbytes = 0
+    try:
+        with open(filepath, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                nbytes += len(chunk)
+                log_progress(
+                    lgr.info,
+                    pid,
+                    "Wrote %d bytes to %s",
+                    nbytes,
+                    filepath,
+                    update=len(chunk),
+                    increment=True,
+                    noninteractive_level=logging.DEBUG,
+                )
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        log_progress(
+            lgr.info,
+            pid,
+            "Finished writing %s",
+            filepath,
+            noninteractive_level=logging.DEBUG,
+        )
+    return nbytes